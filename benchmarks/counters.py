@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Round trips and latency of `update_counters` per call depending on the
+number of fields and counter types, compared with one HINCRBY per field.
+Latency of `most_common(10)` of hash and sorted set backed counters, and
+of top 10 over 90 day counters merged in python or by `most_common_range`.
+
+Usage ::
+
+    python -m benchmarks.counters
+"""
+
+import itertools
+from collections import Counter as PyCounter
+from datetime import datetime, timedelta
+
+from moment.counters import (
+    update_counters, COUNTER_ALIASES, DayCounter, RankedDayCounter
+)
+
+from .utils import register_counting_connection, measure, print_row
+
+
+FIELDS = [1, 5, 20]
+COUNTER_TYPES = [['day'], ['hour', 'day', 'week', 'month']]
+CALLS = 1000
+TOP_SIZES = [1000, 100000, 1000000]
+TOP_CHUNK_SIZE = 10000
+RANGE_DAYS = 90
+RANGE_FIELDS = 10000
+
+
+def update_per_field(client, name, values, counter_types):
+    for cn_type, (k, v) in itertools.product(counter_types, values.items()):
+        counter = COUNTER_ALIASES[cn_type](name, client=client)
+        client.hincrby(counter.key, k, v)
+
+
+def most_common(client):
+    print_row('fields', 'backend', 'ms/call')
+    for size in TOP_SIZES:
+        for backend, counter in [
+                ('hash', DayCounter('bench', client=client)),
+                ('zset', RankedDayCounter('bench', client=client))]:
+            for offset in range(0, size, TOP_CHUNK_SIZE):
+                end = min(offset + TOP_CHUNK_SIZE, size)
+                counter.update(dict(('field{0}'.format(i), i)
+                                    for i in range(offset, end)))
+            _, elapsed = measure(counter.most_common, 10)
+            print_row(size, backend,
+                      '{0:.3f}'.format(elapsed * 1000))
+        client.flushdb()
+
+
+def merge_in_python(client, name, start, end, n):
+    total = PyCounter()
+    for key in DayCounter.period_keys(name, start, end):
+        total.update(dict((k, int(v)) for k, v in client.hgetall(key).items()))
+    return total.most_common(n)
+
+
+def most_common_range(client):
+    end = datetime(2015, 3, 31)
+    start = end - timedelta(days=RANGE_DAYS - 1)
+    for i in range(RANGE_DAYS):
+        counter = DayCounter.from_date('bench', start + timedelta(days=i),
+                                       client)
+        counter.update(dict(('field{0}'.format(f), f + i)
+                            for f in range(RANGE_FIELDS)))
+    print_row('days', 'mode', 'ms/call')
+    modes = [
+        ('python', lambda: merge_in_python(client, 'bench', start, end, 10)),
+        ('redis', lambda: DayCounter.most_common_range(
+            'bench', start, end, 10, client=client)),
+    ]
+    for mode, func in modes:
+        _, elapsed = measure(func)
+        print_row(RANGE_DAYS, mode, '{0:.3f}'.format(elapsed * 1000))
+    client.flushdb()
+
+
+def main():
+    client = register_counting_connection()
+    client.flushdb()
+    print_row('fields', 'types', 'mode', 'round trips', 'ms/call')
+    for fields, counter_types in itertools.product(FIELDS, COUNTER_TYPES):
+        values = dict(('field{0}'.format(i), 1) for i in range(fields))
+        modes = [
+            ('per field', lambda: update_per_field(
+                client, 'bench', values, counter_types)),
+            ('pipeline', lambda: update_counters(
+                'bench', values, counter_types, client=client)),
+            ('atomic', lambda: update_counters(
+                'bench', values, counter_types, client=client, atomic=True)),
+        ]
+        for mode, func in modes:
+            def run():
+                for _ in range(CALLS):
+                    func()
+            round_trips, elapsed = measure(run)
+            print_row(fields, len(counter_types), mode,
+                      round_trips // CALLS,
+                      '{0:.3f}'.format(elapsed * 1000 / CALLS))
+        client.flushdb()
+    print('')
+    most_common(client)
+    print('')
+    most_common_range(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Round trips and latency of `record_events` depending on the batch size.
+
+Usage ::
+
+    python -m benchmarks.record_events
+"""
+
+from moment.bitevents import record_events, Sequence
+
+from .utils import register_counting_connection, measure, print_row
+
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000, 50000]
+EVENT_TYPES = ['hour', 'day', 'week', 'month']
+
+
+def main():
+    client = register_counting_connection()
+    client.flushdb()
+    print_row('batch', 'chunk', 'round trips', 'seconds')
+    for chunk_size in [None, 1000]:
+        for size in BATCH_SIZES:
+            sequence = Sequence('bench', client)
+            uuids = ['user{0}'.format(i) for i in range(size)]
+            # Warm up scripts cache, so we don't count `SCRIPT LOAD` calls.
+            record_events(uuids[:1], 'bench', EVENT_TYPES, client=client,
+                          sequence=sequence)
+            round_trips, elapsed = measure(
+                record_events, uuids, 'bench', EVENT_TYPES, client=client,
+                sequence=sequence, chunk_size=chunk_size or size)
+            print_row(size, chunk_size or size, round_trips,
+                      '{0:.4f}'.format(elapsed))
+            client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
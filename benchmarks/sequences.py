@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory usage and allocation throughput of sorted set and hash backed
+sequences. Requires redis >= 4.0 (`MEMORY USAGE` command).
+
+Usage ::
+
+    python -m benchmarks.sequences
+"""
+
+import time
+
+from moment.bitevents import Sequence, HashSequence
+
+from .utils import register_counting_connection, print_row
+
+
+SIZES = [1000, 100000, 1000000]
+CHUNK_SIZE = 1000
+
+
+def memory_usage(client, *keys):
+    return sum(client.execute_command('MEMORY', 'USAGE', k, 'SAMPLES', 0) or 0
+               for k in keys)
+
+
+def allocate(sequence, size):
+    start = time.time()
+    for offset in range(0, size, CHUNK_SIZE):
+        uuids = ['user{0}'.format(i) for i in range(offset, offset + CHUNK_SIZE)]
+        sequence.sequential_ids(uuids)
+    return time.time() - start
+
+
+def main():
+    client = register_counting_connection()
+    client.flushdb()
+    print_row('backend', 'uuids', 'bytes/uuid', 'ids/sec')
+    for size in SIZES:
+        sequences = [
+            ('zset', Sequence('bench', client, cache_size=0)),
+            ('hash', HashSequence('bench', client, cache_size=0)),
+            ('hash+reverse', HashSequence('bench_rev', client, cache_size=0,
+                                          reverse=True)),
+        ]
+        for backend, sequence in sequences:
+            elapsed = allocate(sequence, size)
+            keys = [sequence.key]
+            if backend != 'zset':
+                keys.extend([sequence.counter_key, sequence.reverse_key])
+            used = memory_usage(client, *keys)
+            print_row(backend, size, '{0:.1f}'.format(float(used) / size),
+                      int(size / elapsed))
+        client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
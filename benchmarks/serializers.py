@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Serialize/deserialize throughput and stored bytes of plain and compressed
+serializers for 1-4 KB json documents. Doesn't require redis.
+
+Usage ::
+
+    python -m benchmarks.serializers
+"""
+
+import time
+import random
+
+from moment.compat import json
+from moment.serializers import CompressedSerializer, get_codec
+
+from .utils import print_row
+
+
+DOCUMENTS = 1000
+CODECS = ['zlib', 'lz4', 'zstd']
+WORDS = ['user', 'event', 'click', 'view', 'page', 'session', 'referrer',
+         'campaign', 'mobile', 'desktop', 'country', 'city', 'product']
+
+
+def make_document(rnd, size):
+    doc, i = {}, 0
+    while len(json.dumps(doc)) < size:
+        key = '{0}_{1}'.format(rnd.choice(WORDS), i)
+        doc[key] = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 8)))
+        doc[key + '_id'] = rnd.randint(0, 10 ** 9)
+        i += 1
+    return doc
+
+
+def main():
+    rnd = random.Random(42)
+    docs = [make_document(rnd, rnd.randint(1024, 4096))
+            for _ in range(DOCUMENTS)]
+    serializers = [('json', json)]
+    for name in CODECS:
+        try:
+            get_codec(name)
+        except LookupError:
+            print('Codec `{0}` is not installed, skipped.'.format(name))
+            continue
+        for level in [1, None]:
+            label = '{0}:{1}'.format(name, 'default' if level is None else level)
+            serializers.append((label, CompressedSerializer(
+                json, codec=name, threshold=0, level=level)))
+
+    print_row('serializer', 'dumps/sec', 'loads/sec', 'bytes/doc', 'ratio')
+    raw_size = None
+    for label, serializer in serializers:
+        start = time.time()
+        dumped = [serializer.dumps(doc) for doc in docs]
+        dumps_elapsed = time.time() - start
+        start = time.time()
+        for value in dumped:
+            serializer.loads(value)
+        loads_elapsed = time.time() - start
+        size = float(sum(len(v) for v in dumped)) / len(docs)
+        raw_size = raw_size or size
+        print_row(label, int(len(docs) / dumps_elapsed),
+                  int(len(docs) / loads_elapsed), int(size),
+                  '{0:.2f}'.format(size / raw_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory usage per item of legacy and compact timelines. Requires redis >= 4.0
+(`MEMORY USAGE` command).
+
+Usage ::
+
+    python -m benchmarks.timelines
+"""
+
+import time
+
+from moment.timelines import Timeline
+
+from .utils import register_counting_connection, print_row
+
+
+SIZES = [1000, 100000]
+BATCH_SIZE = 1000
+
+
+def fill(timeline, size):
+    now = time.time()
+    for offset in range(0, size, BATCH_SIZE):
+        for i in range(offset, min(offset + BATCH_SIZE, size)):
+            timeline.add({'user': i, 'action': 'click'}, timestamp=now + i)
+
+
+def main():
+    client = register_counting_connection()
+    client.flushdb()
+    print_row('items', 'format', 'bytes/item')
+    for size in SIZES:
+        for label, compact in [('legacy', False), ('compact', True)]:
+            timeline = Timeline('bench', client, compact=compact)
+            fill(timeline, size)
+            used = client.execute_command('MEMORY', 'USAGE', timeline.key,
+                                          'SAMPLES', 0)
+            print_row(size, label, '{0:.1f}'.format(float(used) / size))
+            timeline.delete()
+
+
+if __name__ == '__main__':
+    main()
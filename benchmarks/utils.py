@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from redis.connection import Connection
+
+from moment import conf
+
+
+class CountingConnection(Connection):
+    """ Connection which counts packets sent to redis (i.e. round trips). """
+
+    round_trips = 0
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        return super(CountingConnection, self).send_packed_command(command)
+
+
+def register_counting_connection(alias='bench', **kwargs):
+    kwargs.setdefault('db', 15)
+    kwargs.setdefault('connection_class', CountingConnection)
+    return conf.register_connection(alias, **kwargs)
+
+
+def measure(func, *args, **kwargs):
+    """ Returns `(round_trips, seconds)` spent by `func` call. """
+    round_trips = CountingConnection.round_trips
+    start = time.time()
+    func(*args, **kwargs)
+    elapsed = time.time() - start
+    return CountingConnection.round_trips - round_trips, elapsed
+
+
+def print_row(*columns):
+    print(''.join(str(c).ljust(16) for c in columns))
@@ -4,6 +4,7 @@
 from . import conf  # noqa
 from .base import *
 from .bitevents import *
+from .buffers import *
 from .collections import *
 from .counters import *
 from .timelines import *
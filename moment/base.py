@@ -34,8 +34,40 @@ def _require_defined(parent_cls, instance, name, kind='property',
         raise raise_cls(msg)
 
 
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+class _PeriodValues(object):
+    """ Lightweight holder of period attributes used to format keys. """
+
+    def __init__(self, name):
+        self.name = name
+
+
 class MixinPeriod(object):
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        """ Yields dicts of period attributes between `start` and `end`. """
+        raise NotImplementedError("`{0}` subclass of `MixinPeriod` should "
+                                  "define `iter_periods` classmethod."
+                                  .format(cls.__name__))
+
+    @classmethod
+    def period_keys(cls, name, start, end):
+        """
+        Yields keys of all periods between `start` and `end` dates (inclusive)
+        without creating period instances.
+        """
+        values = _PeriodValues(name)
+        namespace = getattr(cls, 'namespace', None)
+        for period in cls.iter_periods(_to_datetime(start), _to_datetime(end)):
+            values.__dict__.update(period)
+            yield _key(cls.key_format.format(self=values), namespace)
+
     def next(self):
         return self.delta(value=1)
 
@@ -153,6 +185,15 @@ class BaseHour(Base, MixinPeriod):
         self.day = not_none(day, now.day)
         self.hour = not_none(hour, now.hour)
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        dt = datetime(start.year, start.month, start.day, start.hour)
+        step = timedelta(hours=1)
+        while dt <= end:
+            yield {'year': dt.year, 'month': dt.month, 'day': dt.day,
+                   'hour': dt.hour}
+            dt += step
+
     def delta(self, value):
         dt = datetime(self.year, self.month, self.day, self.hour) + timedelta(hours=value)
         return self.clone(year=dt.year, month=dt.month, day=dt.day, hour=dt.hour)
@@ -186,6 +227,14 @@ class BaseDay(Base, MixinPeriod):
         self.month = not_none(month, now.month)
         self.day = not_none(day, now.day)
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        dt, end = start.date(), end.date()
+        step = timedelta(days=1)
+        while dt <= end:
+            yield {'year': dt.year, 'month': dt.month, 'day': dt.day}
+            dt += step
+
     def delta(self, value):
         dt = date(self.year, self.month, self.day) + timedelta(days=value)
         return self.clone(year=dt.year, month=dt.month, day=dt.day)
@@ -218,6 +267,13 @@ class BaseMonth(Base, MixinPeriod):
         self.year = not_none(year, now.year)
         self.month = not_none(month, now.month)
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            yield {'year': year, 'month': month}
+            year, month = add_month(year, month, 1)
+
     def delta(self, value):
         year, month = add_month(self.year, self.month, value)
         return self.clone(year=year, month=month)
@@ -253,10 +309,20 @@ class BaseWeek(Base, MixinPeriod):
         self.year = not_none(year, now_year)
         self.week = not_none(week, now_week)
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        dt, end = start.date(), end.date()
+        dt -= timedelta(days=dt.weekday())  # mon
+        step = timedelta(weeks=1)
+        while dt <= end:
+            year, week, _ = dt.isocalendar()
+            yield {'year': year, 'week': week}
+            dt += step
+
     def delta(self, value):
         dt = iso_to_gregorian(self.year, self.week + value, 1)
         year, week, _ = dt.isocalendar()
-        return self.__class__(self.name, year, week, self.client)
+        return self.clone(year=year, week=week)
 
     def period_start(self):
         s = iso_to_gregorian(self.year, self.week, 1)  # mon
@@ -287,6 +353,11 @@ class BaseYear(Base, MixinPeriod):
         now = datetime.utcnow()
         self.year = not_none(year, now.year)
 
+    @classmethod
+    def iter_periods(cls, start, end):
+        for year in range(start.year, end.year + 1):
+            yield {'year': year}
+
     def delta(self, value):
         return self.clone(year=self.year + value)
 
@@ -1,28 +1,106 @@
 # -*- coding: utf-8 -*-
 
+import time
 import itertools
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from . import conf
-from .base import _key, Base, BaseHour, BaseDay, BaseWeek, BaseMonth, BaseYear
-from .collections import BaseSequence
-from .lua import msetbit
+from .base import (
+    _key, _to_datetime, Base, MixinPeriod, BaseHour, BaseDay, BaseWeek,
+    BaseMonth, BaseYear
+)
+from .cache import CacheStats
+from .collections import BaseSequence, BaseHashSequence
+from .compat import basestring
+from .lua import (
+    msetbits, bitop_eval, bitop_and_counts, bitop_funnel, rollup_or
+)
+from .utils import iter_set_bits, not_none, to_timestamp
 
 
 __all__ = ['EVENT_NAMESPACE', 'EVENT_ALIASES', 'SEQUENCE_NAMESPACE',
-           'record_events', 'delete_temporary_bitop_keys', 'Sequence',
-           'Event', 'HourEvent', 'DayEvent', 'MonthEvent', 'WeekEvent',
-           'YearEvent', 'Or', 'And', 'Xor', 'Not', 'LDiff']
+           'HASH_SEQUENCE_NAMESPACE', 'record_events', 'rollup_events',
+           'retention_matrix',
+           'funnel', 'delete_temporary_bitop_keys', 'BitOpScope', 'Sequence',
+           'HashSequence', 'Event', 'HourEvent', 'DayEvent', 'MonthEvent',
+           'WeekEvent', 'YearEvent', 'MixinMaterialized', 'Or', 'And', 'Xor',
+           'Not', 'LDiff']
 
 
 EVENT_NAMESPACE = 'evt'
 SEQUENCE_NAMESPACE = 'seq'
+HASH_SEQUENCE_NAMESPACE = 'hseq'
+
+
+def _versions_key():
+    """ Hash with write versions of bitmaps, used by bitop result cache. """
+    return _key('_versions', EVENT_NAMESPACE)
+
+
+def _fingerprints_key():
+    """ Hash with input versions of cached bitop results. """
+    return _key('_bitop_fingerprints', EVENT_NAMESPACE)
+
+
+def _rollup_key(name, event_type):
+    """
+    Sorted set of finer period keys pending rollup into `event_type`
+    periods, scored by start.
+    """
+    return _key('_rollup:{0}:{1}'.format(name, event_type.__name__),
+                EVENT_NAMESPACE)
+
+
+def _pending_keys(client, name, event_type, start, end):
+    """
+    Keys of `name` periods pending rollup into `event_type` periods started
+    between given dates.
+    """
+    keys = client.zrangebyscore(_rollup_key(name, event_type),
+                                to_timestamp(start), to_timestamp(end))
+    return [k.decode() if isinstance(k, bytes) else k for k in keys]
+
+
+def _events_pending_keys(client, events):
+    """
+    Bulk version of `Event.pending_keys()`, all keys are fetched with a
+    single pipeline and only when some of `events` use rollup.
+    """
+    queries = [ev._pending_query() if isinstance(ev, Event) else None
+               for ev in events]
+    if not any(queries):
+        return [[] for _ in events]
+    with client.pipeline(transaction=False) as pipe:
+        for query in filter(None, queries):
+            name, event_type, start, end = query
+            pipe.zrangebyscore(_rollup_key(name, event_type),
+                               to_timestamp(start), to_timestamp(end))
+        fetched = iter(pipe.execute())
+    result = []
+    for ev, query in zip(events, queries):
+        keys = next(fetched) if query else []
+        keys = [k.decode() if isinstance(k, bytes) else k for k in keys]
+        result.append([k for k in keys if k != ev.key])
+    return result
 
 
 def record_events(uuids, event_names, event_types=None, dt=None, client='default',
-                  sequence=None):
+                  sequence=None, chunk_size=None, rollup=False):
     """
     Records events for hours, days, weeks and months.
 
+    All bits for a chunk of `uuids` (see `conf.MOMENT_RECORD_CHUNK_SIZE`) are
+    set with a single script call, sequential ids are resolved in the same call.
+
+    With `rollup` only the finest of `event_types` periods is written and
+    registered as pending for each of coarser `event_types`, which are
+    derived from it later by `rollup_events()`. Returned events are created
+    with `rollup` flag, so they include pending periods and stay exact
+    before the rollup.
+
+    Materialized event types (see `MixinMaterialized`) are never written,
+    their source events are written instead.
+
     Examples::
 
         seq = Sequence('sequence1')
@@ -31,6 +109,7 @@ def record_events(uuids, event_names, event_types=None, dt=None, client='default
         record_events('foo_id', 'event1', MonthEvent, 'sequence1')
         record_events('foo_id', ['event1', 'event2'], [DayEvent, MonthEvent], seq)
         record_events('foo_id', ['event1', 'event2'], ['day', 'month'], 'sequence1')
+        record_events('foo_id', 'event1', ['hour', 'day', 'month'], rollup=True)
     """
     client = conf.get_connection(client)
 
@@ -52,31 +131,108 @@ def record_events(uuids, event_names, event_types=None, dt=None, client='default
     if dt is None:
         dt = datetime.utcnow()
 
-    events = []
-    for name, ev_type in itertools.product(event_names, event_types):
-        events.append(ev_type.from_date(name, dt, client, sequence=sequence))
-
-    first = events[0]
-    keys = [ev.key for ev in events]
-    # TODO: make single `msetbit` call
-    for uuid in uuids:
-        if len(events) == 1:
-            # For single event just set bit directly
-            first.record(uuid)
-        else:
-            # Because sequence the same for all events
-            sid = first.sequential_id(uuid)
-            msetbit(keys=keys, args=([sid, 1] * len(keys)), client=client)
+    write_types = []
+    for ev_type in event_types:
+        while issubclass(ev_type, MixinMaterialized):
+            ev_type = ev_type.source_type
+        if ev_type not in write_types:
+            write_types.append(ev_type)
+
+    kwargs = {'rollup': True} if rollup else {}
+    events, written = [], []
+    for name in event_names:
+        for ev_type in event_types:
+            events.append(ev_type.from_date(name, dt, client,
+                                            sequence=sequence, **kwargs))
+        for ev_type in write_types:
+            written.append(ev_type.from_date(name, dt, client,
+                                             sequence=sequence, **kwargs))
+
+    coarser = []
+    if rollup:
+        period_length = lambda ev: ev.period_end() - ev.period_start()
+        finest = type(min(written, key=period_length))
+        written = [ev for ev in written if type(ev) is finest]
+        coarser = [t for t in write_types if t is not finest]
+
+    first = written[0]
+    keys = [ev.key for ev in written]
+    chunk_size = chunk_size or conf.MOMENT_RECORD_CHUNK_SIZE
+    uuids = list(uuids)
+    for offset in range(0, len(uuids), chunk_size):
+        # Because sequence the same for all events
+        first.sequential_ids(uuids[offset:offset + chunk_size], keys)
+
+    if coarser:
+        # Registered after bits are set: if a concurrent rollup has already
+        # removed the key, it will be rolled up again with the new bits.
+        with client.pipeline(transaction=False) as pipe:
+            for ev, ev_type in itertools.product(written, coarser):
+                pipe.zadd(_rollup_key(ev.name, ev_type),
+                          to_timestamp(ev.period_start()), ev.key)
+            pipe.execute()
 
     return events
 
 
+def rollup_events(event_names, event_types, until=None, client='default',
+                  batch_size=100):
+    """
+    ORs finer periods recorded by `record_events(..., rollup=True)` and
+    started before `until` (an hour ago by default) into `event_types`
+    periods. Every event type has its own pending set, so types can be
+    rolled up independently. Every batch is rolled up and removed from the
+    pending set by a single atomic script call, so the job can be stopped
+    and resumed at any moment. Returns the number of rolled up
+    `(period, event type)` pairs.
+
+    Examples::
+
+        record_events('foo_id', 'event1', ['hour', 'day', 'month'], rollup=True)
+        rollup_events('event1', ['day', 'month'])
+    """
+    client = conf.get_connection(client)
+
+    if not isinstance(event_names, (list, tuple, set)):
+        event_names = [event_names]
+    if (isinstance(event_types, basestring) or
+            not isinstance(event_types, (list, tuple, set))):
+        event_types = [event_types]
+    event_types = [EVENT_ALIASES.get(t, t) for t in event_types]
+
+    if until is None:
+        until = datetime.utcnow() - timedelta(hours=1)
+
+    total = 0
+    for name, ev_type in itertools.product(event_names, event_types):
+        pending_key = _rollup_key(name, ev_type)
+        while True:
+            pending = client.zrangebyscore(
+                pending_key, '-inf', '({0}'.format(to_timestamp(until)),
+                0, batch_size, withscores=True)
+            if not pending:
+                break
+            keys = [_versions_key(), pending_key]
+            for source, score in pending:
+                dt = datetime.utcfromtimestamp(score)
+                keys.append(source)
+                keys.append(ev_type.from_date(name, dt, client).key)
+            total += rollup_or(keys=keys, args=[1], client=client)
+            if len(pending) < batch_size:
+                break
+    return total
+
+
 class Sequence(BaseSequence):
-    cache_size = 100
     namespace = SEQUENCE_NAMESPACE
     key_format = '{self.name}'
 
 
+class HashSequence(BaseHashSequence):
+    namespace = HASH_SEQUENCE_NAMESPACE
+    key_format = '{self.name}'
+
+
 class MixinBitwise(object):
 
     def __invert__(self):
@@ -95,14 +251,73 @@ class MixinBitwise(object):
         return LDiff(self.client, self, other)
 
 
+class _EventKey(object):
+    """ Minimal bit operation operand: existing bitmap key and sequence. """
+    __slots__ = ('key', 'sequence')
+
+    def __init__(self, key, sequence=None):
+        self.key = key
+        self.sequence = sequence
+
+
 class Event(Base, MixinBitwise):
     namespace = EVENT_NAMESPACE
     key_format = '{self.name}'
-    clonable_attrs = ['sequence']
+    clonable_attrs = ['sequence', 'rollup']
+    # Used to create sequence when it's given by name.
+    sequence_class = Sequence
 
-    def __init__(self, name, client='default', sequence=None):
+    def __init__(self, name, client='default', sequence=None, rollup=None):
         super(Event, self).__init__(name, client)
         self.sequence = sequence
+        self.rollup = not_none(rollup, conf.MOMENT_EVENT_ROLLUP)
+
+    @classmethod
+    def range(cls, name, start, end, period=None, client='default',
+              sequence=None, rollup=None):
+        """
+        Union of `name` events for all periods between `start` and `end`
+        (inclusive). Period keys are generated directly and the result is
+        a lazy `Or` operation, so `count()` is a single script call which
+        doesn't store anything. Period defaults to the class period or day.
+        With `rollup` (defaults to `conf.MOMENT_EVENT_ROLLUP`) finer periods
+        pending rollup within the range are included as well (see
+        `record_events()`).
+
+        Examples::
+
+            end = datetime.utcnow()
+            active = Event.range('active', end - timedelta(days=89), end)
+            active = DayEvent.range('active', end - timedelta(days=89), end)
+            active = Event.range('active', start, end, 'week', sequence='users')
+            len(active)
+        """
+        if period is None:
+            period = cls if issubclass(cls, MixinPeriod) else DayEvent
+        event_type = EVENT_ALIASES.get(period, period)
+        client = conf.get_connection(client)
+        if isinstance(sequence, basestring):
+            sequence = cls.sequence_class(sequence, client)
+        if issubclass(event_type, MixinMaterialized):
+            events = []
+            for values in event_type.iter_periods(_to_datetime(start),
+                                                  _to_datetime(end)):
+                ev = event_type(name, client=client, sequence=sequence)
+                ev.__dict__.update(values)
+                events.append(ev)
+        else:
+            events = [_EventKey(key, sequence)
+                      for key in event_type.period_keys(name, start, end)]
+        if not_none(rollup, conf.MOMENT_EVENT_ROLLUP):
+            # Materialized events include pending keys of their sources.
+            target = getattr(event_type, 'source_type', None) or event_type
+            first = event_type.from_date(name, _to_datetime(start), client)
+            last = event_type.from_date(name, _to_datetime(end), client)
+            keys = set(ev.key for ev in events)
+            events.extend(_EventKey(key, sequence) for key in _pending_keys(
+                client, name, target, first.period_start(), last.period_end())
+                if key not in keys)
+        return Or(client, *events)
 
     def sequence():
         def fget(self):
@@ -111,7 +326,7 @@ class Event(Base, MixinBitwise):
         def fset(self, sequence):
             """ Automatically create `Sequence` instance by name. """
             if isinstance(sequence, basestring):
-                sequence = Sequence(sequence, self.client)
+                sequence = self.sequence_class(sequence, self.client)
             self._sequence = sequence
 
         return locals()
@@ -127,20 +342,116 @@ class Event(Base, MixinBitwise):
             raise ValueError("A `Sequence` instance is required "
                              "to use non integer uuid `%s`." % (uuid,))
 
+    def sequential_ids(self, uuids, setbit_keys=None):
+        """
+        Bulk version of `sequential_id`, optionally sets resolved ids
+        in `setbit_keys` bitmaps within the same call.
+        """
+        if self.sequence is not None:
+            return self.sequence.sequential_ids(
+                uuids, setbit_keys=setbit_keys, versions_key=_versions_key())
+        sids = [self.sequential_id(uuid) for uuid in uuids]
+        if setbit_keys:
+            keys = [_versions_key()] + list(setbit_keys)
+            msetbits(keys=keys, args=sids, client=self.client)
+        return sids
+
+    def pending_keys(self):
+        """
+        Keys of finer periods recorded with `rollup` and not rolled up into
+        this event yet (see `rollup_events()`).
+        """
+        return _events_pending_keys(self.client, [self])[0]
+
+    def _pending_query(self):
+        """ Returns `(name, event_type, start, end)` of pending keys lookup. """
+        if self.rollup and isinstance(self, MixinPeriod):
+            return (self.name, type(self),
+                    self.period_start(), self.period_end())
+
+    def _with_pending(self, pending=None):
+        """ Returns `Or` of the event and its pending keys if there are any. """
+        if pending is None:
+            pending = self.pending_keys()
+        if pending:
+            keys = [self.key] + pending
+            return Or(self.client, *[_EventKey(k, self.sequence) for k in keys])
+
     def is_recorded(self, uuid):
-        if self.sequence is not None and uuid not in self.sequence:
-            return False
-        sid = self.sequential_id(uuid)
+        op = self._with_pending()
+        if op is not None:
+            return op.is_recorded(uuid)
+        if self.sequence is not None:
+            sid, = self.sequence.sequential_ids([uuid], create=False)
+            if sid is None:
+                return False
+        else:
+            sid = self.sequential_id(uuid)
         return bool(self.client.getbit(self.key, sid))
 
     def record(self, uuid):
-        return self.client.setbit(self.key, self.sequential_id(uuid), 1)
+        sid = self.sequential_id(uuid)
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.setbit(self.key, sid, 1)
+            pipe.hincrby(_versions_key(), self.key, 1)
+            return pipe.execute()[0]
+
+    def iter_ids(self, chunk_size=None):
+        """
+        Yields sequential ids of recorded members. Bitmap is fetched by
+        `chunk_size` bytes (see `conf.MOMENT_BITMAP_CHUNK_SIZE`).
+        """
+        op = self._with_pending()
+        if op is not None:
+            for sid in op.iter_ids(chunk_size):
+                yield sid
+            return
+        chunk_size = chunk_size or conf.MOMENT_BITMAP_CHUNK_SIZE
+        start = 0
+        while True:
+            data = self.client.getrange(self.key, start, start + chunk_size - 1)
+            if not data:
+                break
+            for sid in iter_set_bits(data, start * 8):
+                yield sid
+            if len(data) < chunk_size:
+                break
+            start += chunk_size
+
+    def members(self, chunk_size=None, batch_size=1000):
+        """
+        Yields uuids of recorded members (or sequential ids if there is no
+        sequence). Uuids are resolved by `batch_size` ids per call.
+
+        Examples::
+
+            ev = DayEvent('active', sequence='users')
+            for uuid in ev.members():
+                print uuid
+        """
+        ids = self.iter_ids(chunk_size)
+        if self.sequence is None:
+            for sid in ids:
+                yield sid
+            return
+        while True:
+            batch = list(itertools.islice(ids, batch_size))
+            if not batch:
+                break
+            for uuid in self.sequence.uuids(batch):
+                yield uuid
 
     def count(self):
+        op = self._with_pending()
+        if op is not None:
+            return op.count()
         return self.client.bitcount(self.key)
 
     def delete(self, cascade=False):
-        self.client.delete(self.key)
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.delete(self.key)
+            pipe.hincrby(_versions_key(), self.key, 1)
+            pipe.execute()
         if cascade and self.sequence is not None:
             self.sequence.delete()
 
@@ -174,34 +485,116 @@ class MonthEvent(BaseMonth, Event):
     pass
 
 
-class YearEvent(BaseYear, Event):
+class MixinMaterialized(object):
+    """
+    Event of a coarse period which bitmap is materialized from events of
+    finer `source_type` periods, e.g. year from months. The bitmap is stored
+    under the event own key without ttl and is rebuilt by a single `Or`
+    script call on read, only when some of the source events were written
+    since the last build (see `BitOperation` result cache). Materialized
+    events are read only, record source events instead.
 
-    def __init__(self, name, year=None, client='default', sequence=None):
-        super(YearEvent, self).__init__(name, client, year)
-        self.sequence = sequence
+    Examples::
 
-    def months(self):
-        if not hasattr(self, '_months'):
-            month = lambda i: MonthEvent(self.name, self.year, i, self.client, self.sequence)
-            self._months = Or(*[month(i) for i in range(1, 13)])
-        return self._months
+        class MonthFromDaysEvent(MixinMaterialized, BaseMonth, Event):
+            namespace = 'evt_m'
+            source_type = DayEvent
+    """
+    source_type = None
+
+    def source_keys(self):
+        if self.source_type is None:
+            raise NotImplementedError(
+                "`{0}` subclass of `MixinMaterialized` should define "
+                "`source_type` attribute.".format(self.__class__.__name__))
+        return self.source_type.period_keys(
+            self.name, self.period_start(), self.period_end())
+
+    def sources(self):
+        """
+        Returns `Or` operation of source events stored into own key. With
+        `rollup` it includes finer periods pending rollup into sources.
+        """
+        keys = list(self.source_keys())
+        if self.rollup:
+            keys.extend(_pending_keys(self.client, self.name, self.source_type,
+                                      self.period_start(), self.period_end()))
+        events = [_EventKey(key, self.sequence) for key in keys]
+        op = Or(self.client, *events)
+        op.result_key = self.key
+        op.use_cache = True
+        op.ttl = 0
+        return op
+
+    def materialize(self):
+        self.sources().evaluate()
+        return self
+
+    def _pending_query(self):
+        # Pending keys are already included into sources.
+        return None
 
-    @property
-    def key(self):
-        return self.months.key
+    def count(self):
+        # Cached `count` stores the result, so it's a single call as well.
+        return self.sources().count()
+
+    def is_recorded(self, uuid):
+        self.materialize()
+        return super(MixinMaterialized, self).is_recorded(uuid)
+
+    def iter_ids(self, chunk_size=None):
+        self.materialize()
+        return super(MixinMaterialized, self).iter_ids(chunk_size)
+
+    def record(self, uuid):
+        raise NotImplementedError(
+            "`{0}` is materialized from `{1}` events, record them instead."
+            .format(self.__class__.__name__, self.source_type.__name__))
 
     def delete(self, cascade=False):
-        self.client.delete(self.key)
+        super(MixinMaterialized, self).delete()
         if cascade:
-            self.months.delete(cascade=cascade)
+            with self.client.pipeline(transaction=False) as pipe:
+                for key in self.source_keys():
+                    pipe.delete(key)
+                    pipe.hincrby(_versions_key(), key, 1)
+                pipe.execute()
+
+
+class YearEvent(MixinMaterialized, BaseYear, Event):
+    source_type = MonthEvent
+
+    def __init__(self, name, year=None, client='default', sequence=None,
+                 **kwargs):
+        super(YearEvent, self).__init__(name, year, client, sequence=sequence,
+                                        **kwargs)
+
+    def months(self):
+        """ Lazy `Or` of the year month events. """
+        return Or(self.client, *[
+            MonthEvent(self.name, self.year, i, self.client, self.sequence)
+            for i in range(1, 13)])
 
 
 class BitOperation(Event):
     """
     Base class for bit operations (AND, OR, XOR, NOT).
 
-    Please note that each bit operation creates a new key  prefixed with
-    `spm:bitop_`. Bit operations can be nested.
+    Bit operations can be nested and are evaluated lazily: the whole tree
+    is evaluated by a single script call when it's used for the first time.
+    `count()` doesn't store anything, other methods (or explicit
+    `evaluate()` call) store the result into a new key prefixed with
+    `spm:evt:bitop_`. Nested operations never create intermediate keys.
+
+    With result cache enabled (`use_cache` or `conf.MOMENT_BITOP_CACHE`)
+    stored result is reused, while none of the operands was written since
+    the last evaluation. Writes are tracked by `record_events()`,
+    `Event.record()` and `Event.delete()`. Hit rate is reported by
+    `BitOperation.cache_stats`.
+
+    Stored results expire after `ttl` seconds (`conf.MOMENT_BITOP_TTL` by
+    default), expired results are evaluated again on the next use. Use
+    `BitOpScope` to delete them as soon as they are not needed.
 
     Examples::
 
@@ -209,7 +602,14 @@ class BitOperation(Event):
         m2 = Month('event1', 2015, 2, s1)
         m3 = Month('event1', 2015, 3, s1)
         m2 & m3 == And(m2, m3)
+        len((m2 & m3) - (m2 | m3)) == 0
     """
+    min_events = 1
+    use_cache = None
+    cache_stats = CacheStats()
+    ttl = None
+    result_key = None
+
     def __init__(self, op_name, client_or_event, *events):
         if hasattr(client_or_event, 'key'):
             events = list(events)
@@ -219,8 +619,9 @@ class BitOperation(Event):
             client = client_or_event
 
         cls_name = self.__class__.__name__
-        assert events, \
-            "At least one event should be given to perform `%s` operation." % (cls_name,)
+        assert len(events) >= self.min_events, \
+            "At least %s event(s) should be given to perform `%s` operation." % (
+                self.min_events, cls_name)
 
         sequences = [ev.sequence for ev in events]
         s1 = sequences[0]
@@ -233,19 +634,138 @@ class BitOperation(Event):
 
         self.op_name = op_name
         self.events = events
-        self.event_keys = [ev.key for ev in events]
-        self.evaluate()
+        self.is_evaluated = False
+
+    @property
+    def event_keys(self):
+        return [ev.key for ev in self.events]
 
     @property
     def key(self):
+        if self.result_key is not None:
+            return self.result_key
         k = '{0.name}:({1})'
-        return _key(k.format(self, '~'.join(self.event_keys)))
+        return _key(k.format(self, '~'.join(self.event_keys)), self.namespace)
+
+    def compile(self):
+        """
+        Returns `(keys, program)` arguments of `bitop_eval` script for the
+        operations tree. Already evaluated nested operations are used as is,
+        unless they are cached or expired: cached results may be outdated,
+        so such operations are compiled inline and their leaves are
+        validated. Cached operations compile all nested operations inline,
+        because only cached results have write versions. Pending keys of
+        all leaves are fetched at once.
+        """
+        leaves = list(self._iter_leaves())
+        pending = _events_pending_keys(self.client, leaves)
+        pending = dict(zip(map(id, leaves), pending))
+        keys, program = [], []
+        self._compile(keys, {}, program, pending, self.is_cached)
+        return keys + [_versions_key(), _fingerprints_key(), self.key], program
+
+    def _iter_leaves(self):
+        for ev in self.events:
+            if isinstance(ev, BitOperation):
+                for leaf in ev._iter_leaves():
+                    yield leaf
+            else:
+                yield ev
+
+    def _compile(self, keys, indexes, program, pending_keys, inline=False):
+        for ev in self.events:
+            if isinstance(ev, BitOperation) and (inline or ev.is_cached or
+                                                 not ev._is_stored()):
+                ev._compile(keys, indexes, program, pending_keys, inline)
+                continue
+            if isinstance(ev, MixinMaterialized):
+                ev.materialize()
+            pending = pending_keys.get(id(ev), [])
+            for key in [ev.key] + pending:
+                if key not in indexes:
+                    keys.append(key)
+                    indexes[key] = len(keys)
+                program.extend(['KEY', indexes[key]])
+            if pending:
+                program.extend(['OR', len(pending) + 1])
+        program.extend([self.op_name, len(self.events)])
+
+    @property
+    def is_cached(self):
+        return not_none(self.use_cache, conf.MOMENT_BITOP_CACHE)
+
+    def _eval(self, mode):
+        keys, program = self.compile()
+        cache = self.is_cached
+        ttl = not_none(self.ttl, conf.MOMENT_BITOP_TTL) or 0
+        args = [mode, 1 if cache else 0, ttl] + program
+        hit, count = bitop_eval(keys=keys, args=args, client=self.client)
+        if cache:
+            if hit:
+                self.cache_stats.hits += 1
+            else:
+                self.cache_stats.misses += 1
+        if mode == 'store' or cache:
+            self.is_evaluated = True
+            if self.result_key is None:
+                # Explicit result keys are owned by the caller.
+                BitOpScope.register(self)
+        return count
 
     def evaluate(self):
-        self.client.bitop(self.op_name, self.key, *self.event_keys)
+        self._eval('store')
+        return self
+
+    def _is_stored(self):
+        """ Whether evaluated result is still stored, it may have expired. """
+        if not self.is_evaluated:
+            return False
+        if not_none(self.ttl, conf.MOMENT_BITOP_TTL) and \
+                not self.client.exists(self.key):
+            self.is_evaluated = False
+        return self.is_evaluated
+
+    def materialize(self):
+        """
+        Evaluates operation unless result key is already stored. Cached
+        result is validated on each call.
+        """
+        if self.is_cached or not self._is_stored():
+            self.evaluate()
+        return self
+
+    def count(self):
+        if self.is_evaluated and not self.is_cached:
+            with self.client.pipeline(transaction=False) as pipe:
+                pipe.exists(self.key)
+                pipe.bitcount(self.key)
+                exists, count = pipe.execute()
+            if exists:
+                return count
+            # Expired or empty result, count it again.
+            self.is_evaluated = False
+        return self._eval('count')
+
+    def is_recorded(self, uuid):
+        self.materialize()
+        return super(BitOperation, self).is_recorded(uuid)
+
+    def iter_ids(self, chunk_size=None):
+        self.materialize()
+        return super(BitOperation, self).iter_ids(chunk_size)
+
+    def expire(self, ttl):
+        self.materialize()
+        super(BitOperation, self).expire(ttl)
+
+    def __bool__(self):
+        return self.count() > 0
+
+    __nonzero__ = __bool__
 
     def delete(self, cascade=False):
-        self.client.delete(self.key)
+        super(BitOperation, self).delete()
+        self.is_evaluated = False
         if cascade:
             for ev in self.events:
                 if isinstance(ev, BitOperation):
@@ -280,26 +800,17 @@ class Not(BitOperation):
         super(Not, self).__init__('NOT', client_or_event, *events)
 
 
-# TODO: rewrite to lua script
 class LDiff(BitOperation):
     """
     Left diff bitwise operation:
 
     LDiff(A, B, C) == A - (B & C) == A & ~(B & C)
     """
+    min_events = 2
+
     def __init__(self, client_or_event, *events):
-        assert len(events) > 1, \
-            "At least two events should be given to perform `LDiff` operation."
         super(LDiff, self).__init__('_LDIFF', client_or_event, *events)
 
-    def evaluate(self):
-        left, tail = self.events[0], self.events[1:]
-        if len(tail) > 1:
-            right = Not(And(self.client, *tail))
-        else:
-            right = Not(self.client, tail[0])
-        self.client.bitop('AND', self.key, left.key, right.key)
-
 
 EVENT_ALIASES = {
     'hour': HourEvent,
@@ -310,11 +821,220 @@ EVENT_ALIASES = {
 }
 
 
-def delete_temporary_bitop_keys(client='default', dryrun=False):
-    """ Delete all temporary keys that are used when using bit operations. """
+def retention_matrix(cohort_event, activity_event, period_type='day',
+                     start=None, periods=7, client='default', sequence=None,
+                     rollup=None):
+    """
+    Cohort retention table for `periods` periods starting from `start` date.
+    Cell `[i][j]` is number of members who did `cohort_event` in `i`-th
+    period and `activity_event` `j` periods later. All cells are counted
+    with a single script call, nothing is stored. With `rollup` (defaults to
+    `conf.MOMENT_EVENT_ROLLUP`) periods having finer periods pending rollup are merged with them first into
+    temporary keys, which are deleted before return.
+
+    Examples::
+
+        matrix = retention_matrix('signup', 'active', 'week', periods=4)
+        matrix == [[100, 60, 40, 35],
+                   [120, 70, 50],
+                   [90, 55],
+                   [110]]
+    """
+    client = conf.get_connection(client)
+    event_type = EVENT_ALIASES.get(period_type, period_type)
+    cohort = event_type.from_date(cohort_event, start, client,
+                                  sequence=sequence, rollup=rollup)
+    activity = event_type.from_date(activity_event, start, client,
+                                    sequence=sequence, rollup=rollup)
+
+    events = [cohort.delta(i) for i in range(periods)]
+    events += [activity.delta(i) for i in range(periods)]
+    args = []
+    for i in range(periods):
+        for j in range(periods - i):
+            args.extend([i + 1, periods + i + j + 1])
+    with BitOpScope():
+        keys = []
+        pending = _events_pending_keys(client, events)
+        for ev, ev_pending in zip(events, pending):
+            if isinstance(ev, MixinMaterialized):
+                ev.materialize()
+            op = ev._with_pending(ev_pending)
+            keys.append(op.evaluate().key if op is not None else ev.key)
+        keys.append(_key('bitop_retention', EVENT_NAMESPACE))
+        counts = iter(bitop_and_counts(keys=keys, args=args, client=client))
+    return [[next(counts) for _ in range(periods - i)] for i in range(periods)]
+
+
+def funnel(events, client=None):
+    """
+    Conversion funnel over ordered `events` (each with its own period).
+    Returns `(count, dropoff)` pair per step, where count is the number of
+    members who did this and all previous steps. All steps are counted with
+    a single script call reusing intersection of previous steps, nothing is
+    stored.
+
+    Examples::
+
+        dt = datetime(2015, 3, 1)
+        funnel([DayEvent.from_date('visit', dt, sequence='users'),
+                DayEvent.from_date('signup', dt, sequence='users'),
+                WeekEvent.from_date('purchase', dt, sequence='users')])
+        == [(1000, 0), (120, 880), (30, 90)]
+    """
+    assert events, 'At least one event should be given to build a funnel.'
+    client = conf.get_connection(client) if client else events[0].client
+
+    s1 = events[0].sequence
+    for ev in events[1:]:
+        if ev.sequence != s1:
+            raise ValueError("Event sequences mismatch (%s != %s)" % (
+                s1, ev.sequence))
+
+    # Operation steps are stored into temporary keys deleted by the scope.
+    with BitOpScope():
+        keys = []
+        pending = _events_pending_keys(client, events)
+        for ev, ev_pending in zip(events, pending):
+            op = ev._with_pending(ev_pending)
+            if op is not None:
+                ev = op
+            if isinstance(ev, (BitOperation, MixinMaterialized)):
+                ev.materialize()
+            keys.append(ev.key)
+        keys.append(_key('bitop_funnel', EVENT_NAMESPACE))
+        counts = bitop_funnel(keys=keys, client=client)
+
+    steps, previous = [], counts[0]
+    for count in counts:
+        steps.append((count, previous - count))
+        previous = count
+    return steps
+
+
+class BitOpScope(object):
+    """
+    Deletes keys of bit operations evaluated inside of the scope on exit.
+    Scopes are thread local and can be nested.
+
+    Examples::
+
+        with BitOpScope():
+            active = DayEvent('active') & DayEvent('paid')
+            active.evaluate()
+            uuids = list(active.members())
+        # Result key of `active` is deleted here.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.operations = []
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @classmethod
+    def register(cls, operation):
+        scope = cls.current()
+        if scope is not None:
+            scope.operations.append(operation)
+
+    def __enter__(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._local.stack.pop()
+        self.delete()
+
+    def delete(self):
+        by_client = {}
+        for op in self.operations:
+            op.is_evaluated = False
+            by_client.setdefault(op.client, set()).add(op.key)
+        for client, keys in by_client.items():
+            _delete_bitop_keys(client, list(keys))
+        self.operations = []
+
+
+def _delete_bitop_keys(client, keys):
+    with client.pipeline(transaction=False) as pipe:
+        pipe.delete(*keys)
+        pipe.hdel(_versions_key(), *keys)
+        pipe.hdel(_fingerprints_key(), *keys)
+        pipe.execute()
+
+
+def _delete_orphan_bitop_fields(client, pattern, batch_size=1000):
+    """
+    Deletes fields of not existing (e.g. expired or deleted) keys from
+    versions hash and fields of not existing bitop keys from fingerprints
+    hash. Returns the number of deleted fields.
+
+    Write versions of a re-created bitmap start over and may repeat the ones
+    stored in fingerprints, so all fingerprints are deleted as well (cached
+    results are evaluated again) when versions of bitmaps are deleted.
+    """
+    prefix = pattern.rstrip('*')
+    deleted, reset = 0, False
+    for hash_key, match in [(_versions_key(), None),
+                            (_fingerprints_key(), pattern)]:
+        if reset:
+            with client.pipeline() as pipe:
+                pipe.hlen(hash_key)
+                pipe.delete(hash_key)
+                deleted += pipe.execute()[0]
+            break
+        fields = client.hscan_iter(hash_key, match=match, count=batch_size)
+        while True:
+            batch = [f for f, _ in itertools.islice(fields, batch_size)]
+            if not batch:
+                break
+            with client.pipeline(transaction=False) as pipe:
+                for field in batch:
+                    pipe.exists(field)
+                exists = pipe.execute()
+            orphans = [f for f, e in zip(batch, exists) if not e]
+            if orphans:
+                deleted += client.hdel(hash_key, *orphans)
+                orphans = [f.decode() if isinstance(f, bytes) else f
+                           for f in orphans]
+                reset = reset or any(not f.startswith(prefix)
+                                     for f in orphans)
+    return deleted
+
+
+def delete_temporary_bitop_keys(client='default', dryrun=False,
+                                batch_size=1000, rate_limit=None):
+    """
+    Delete all temporary keys that are used when using bit operations.
+    Keys are found incrementally with SCAN and deleted by `batch_size` keys,
+    `rate_limit` limits number of deleted keys per second. Cache metadata
+    of expired bitop keys and deleted bitmaps is found with HSCAN and
+    deleted as well.
+    """
     client = conf.get_connection(client)
-    pattertn = '{}:bitop_*'.format(EVENT_NAMESPACE)
-    keys = client.keys(_key(pattertn))
-    if not dryrun and len(keys) > 0:
-        client.delete(*keys)
+    pattertn = _key('{}:bitop_*'.format(EVENT_NAMESPACE))
+    start = time.time()
+    keys, batch = [], []
+    for key in client.scan_iter(pattertn, count=batch_size):
+        keys.append(key)
+        batch.append(key)
+        if len(batch) < batch_size:
+            continue
+        if not dryrun:
+            _delete_bitop_keys(client, batch)
+        batch = []
+        if rate_limit:
+            delay = float(len(keys)) / rate_limit - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+    if batch and not dryrun:
+        _delete_bitop_keys(client, batch)
+    if not dryrun:
+        _delete_orphan_bitop_fields(client, pattertn, batch_size)
     return keys
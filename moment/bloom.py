@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import time
+import struct
+import hashlib
+import threading
+
+__all__ = ['BloomFilter']
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        # Python 2 `unicode`, ints etc.
+        value = u'{0}'.format(value)
+    return value.encode('utf-8')
+
+
+class BloomFilter(object):
+    """
+    Pure python bloom filter sized for `capacity` items with the given
+    false positive rate. There are no false negatives for added items.
+
+    Examples::
+
+        bloom = BloomFilter(1000, error_rate=0.01)
+        bloom.add('foo')
+        'foo' in bloom
+        'bar' not in bloom  # with 99% probability
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        assert capacity > 0, '`capacity` should be positive.'
+        assert 0 < error_rate < 1, '`error_rate` should be in (0, 1) range.'
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.created = time.time()
+        self._lock = threading.Lock()
+
+    def _offsets(self, value):
+        # Double hashing: h1 + i * h2 gives k independent enough hashes.
+        digest = hashlib.md5(_to_bytes(value)).digest()
+        h1, h2 = struct.unpack('>QQ', digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, value):
+        """ Adds value, `count` is incremented for values not seen before. """
+        offsets = list(self._offsets(value))
+        bits = self.bits
+        with self._lock:
+            added = False
+            for offset in offsets:
+                mask = 1 << (offset & 7)
+                if not bits[offset >> 3] & mask:
+                    bits[offset >> 3] |= mask
+                    added = True
+            if added:
+                self.count += 1
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    @property
+    def is_saturated(self):
+        """ False positive rate is no longer bounded by `error_rate`. """
+        return self.count > self.capacity
+
+    def __contains__(self, value):
+        bits = self.bits
+        for offset in self._offsets(value):
+            if not bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
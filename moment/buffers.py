@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import atexit
+import weakref
+import threading
+
+from . import conf
+from .utils import not_none
+
+__all__ = ['BufferStats', 'CounterBuffer']
+
+
+class BufferStats(object):
+    """ Flush counters of `CounterBuffer`. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.flushes = 0
+        self.errors = 0
+        self.increments = 0
+        self.flushed_fields = 0
+        self.max_batch_size = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    @property
+    def mean_batch_size(self):
+        return float(self.flushed_fields) / self.flushes if self.flushes else 0.0
+
+    @property
+    def mean_flush_time(self):
+        return self.flush_time / self.flushes if self.flushes else 0.0
+
+    def as_dict(self):
+        return {
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'increments': self.increments,
+            'flushed_fields': self.flushed_fields,
+            'max_batch_size': self.max_batch_size,
+            'mean_batch_size': self.mean_batch_size,
+            'max_flush_time': self.max_flush_time,
+            'mean_flush_time': self.mean_flush_time,
+        }
+
+
+def _call_if_alive(ref, method):
+    def callback():
+        instance = ref()
+        if instance is not None:
+            getattr(instance, method)()
+    return callback
+
+
+class CounterBuffer(object):
+    """
+    In-process write-behind buffer for counters. Increments are summed in
+    memory by `(key, field)` and written by a single pipeline of HINCRBY
+    commands on `flush()`, which is called by a background thread every
+    `flush_interval` seconds, when `max_size` fields are buffered, at exit
+    and before fork. Buffered increments are not visible to readers until
+    flushed and are lost if the process is killed.
+
+    Examples::
+
+        buffer = CounterBuffer(max_size=10000, flush_interval=1)
+        DayCounter('hits', buffer=buffer).update(['/index'])
+        update_counters('hits', ['/index'], ['day', 'month'], buffer=buffer)
+        DayCounter.buffer = buffer  # for all day counters
+        buffer.flush()
+        buffer.stats()
+    """
+
+    def __init__(self, max_size=None, flush_interval=None):
+        self.max_size = max_size or conf.MOMENT_COUNTER_BUFFER_SIZE
+        self.flush_interval = not_none(
+            flush_interval, conf.MOMENT_COUNTER_BUFFER_INTERVAL)
+        self.counters = BufferStats()
+        self._reset()
+
+        ref = weakref.ref(self)
+        atexit.register(_call_if_alive(ref, 'close'))
+        if hasattr(os, 'register_at_fork'):
+            # Parent flushes so the child doesn't inherit pending increments.
+            os.register_at_fork(before=_call_if_alive(ref, 'flush'),
+                                after_in_child=_call_if_alive(ref, '_reset'))
+
+    def _reset(self):
+        # Pending increments by client: {client: {(key, field): value}}
+        self._pending = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None and self.flush_interval:
+            thread = threading.Thread(target=self._run,
+                                      name='moment-counter-buffer')
+            thread.daemon = True
+            self._thread = thread
+            thread.start()
+
+    def _run(self):
+        closed = self._closed
+        while not closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Increments are kept and retried, see `flush()`.
+                pass
+
+    def add(self, client, key, items):
+        """ Buffers `(field, increment)` items of the counter `key`. """
+        with self._lock:
+            n = self._add(client, (((key, f), v) for f, v in items))
+            self.counters.increments += n
+            if self._thread is None:
+                self._start()
+            is_full = self._size >= self.max_size
+        if is_full:
+            self.flush()
+
+    def _add(self, client, increments):
+        pending = self._pending.setdefault(client, {})
+        n = 0
+        for k, value in increments:
+            if k in pending:
+                pending[k] += value
+            else:
+                pending[k] = value
+                self._size += 1
+            n += 1
+        return n
+
+    def flush(self):
+        """
+        Writes all buffered increments, returns number of written fields.
+        Increments of a failed client are buffered again and the error is
+        raised. Every client is written by a MULTI/EXEC pipeline, so its
+        increments are never applied partially.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._size = self._pending, {}, 0
+            size = sum(len(p) for p in pending.values())
+            if not size:
+                return 0
+            start = time.time()
+            written = []
+            try:
+                for client, increments in pending.items():
+                    with client.pipeline(transaction=True) as pipe:
+                        for (key, field), value in increments.items():
+                            if value:
+                                pipe.hincrby(key, field, value)
+                        pipe.execute()
+                    written.append(client)
+            except Exception:
+                self.counters.errors += 1
+                with self._lock:
+                    for client, increments in pending.items():
+                        if client not in written:
+                            self._add(client, increments.items())
+                raise
+            elapsed = time.time() - start
+
+        stats = self.counters
+        stats.flushes += 1
+        stats.flushed_fields += size
+        stats.max_batch_size = max(stats.max_batch_size, size)
+        stats.flush_time += elapsed
+        stats.max_flush_time = max(stats.max_flush_time, elapsed)
+        return size
+
+    def close(self):
+        """ Stops background thread and flushes buffered increments. """
+        self._closed.set()
+        self.flush()
+
+    def stats(self):
+        result = self.counters.as_dict()
+        result['size'] = self._size
+        return result
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+
+__all__ = ['CacheStats', 'LRUCache']
+
+
+class CacheStats(object):
+    """ Hit/miss/eviction counters shared by local caches. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hit_rate,
+        }
+
+
+class LRUCache(object):
+    """
+    Thread-safe bounded mapping which evicts least recently used items when
+    `maxsize` is exceeded, and items older than `ttl` seconds (if given).
+
+    Examples::
+
+        cache = LRUCache(2)
+        cache['a'], cache['b'], cache['c'] = 1, 2, 3
+        'a' not in cache
+        cache.stats()['evictions'] == 1
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        assert maxsize > 0, '`maxsize` should be positive.'
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.counters = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value, created = self._data.pop(key)
+            except KeyError:
+                self.counters.misses += 1
+                raise
+            if self._is_expired(created):
+                self.counters.expirations += 1
+                self.counters.misses += 1
+                raise KeyError(key)
+            # Re-insert item to mark it as recently used.
+            self._data[key] = (value, created)
+            self.counters.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.counters.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._is_expired(item[1])
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        stats = self.counters.as_dict()
+        stats.update(size=len(self), maxsize=self.maxsize)
+        return stats
@@ -3,15 +3,21 @@
 
 from __future__ import absolute_import
 
+import time
 from . import conf
 from .base import Base, MixinSerializable
-from .compat import lru
+from .bloom import BloomFilter
+from .cache import LRUCache
+from .utils import not_none
 from .lua import (
-    sequential_id as _sequential_id, multiset_union_update,
-    multiset_intersection_update
+    monotonic_zadd_many, sequential_msetbit, zscore_many, hash_sequential_ids,
+    hash_sequential_msetbit, hsetdefault, hpop, multiset_union_update,
+    multiset_intersection_update, ranked_counter_set, ranked_counter_pop,
+    ranked_counter_multiset_update
 )
 
-__all__ = ['BaseSequence', 'BaseDict', 'BaseCounter']
+__all__ = ['BaseSequence', 'BaseHashSequence', 'BaseDict', 'BaseCounter',
+           'BaseRankedCounter']
 
 
 _NONE = object()
@@ -20,7 +26,16 @@ _NONE = object()
 class BaseSequence(Base):
     """
     Tracks sequential ids for symbolic identifiers. Also optionaly holds
-    cache of recenly created ids.
+    cache of recenly created ids. Cache size and ttl default to
+    `conf.MOMENT_SEQUENCE_CACHE_SIZE` and `conf.MOMENT_SEQUENCE_CACHE_TTL`,
+    zero `cache_size` disables the cache.
+
+    Optional bloom filter (see `build_bloom`) answers negative membership
+    checks without a round trip. Bloom filter knows about uuids created by
+    this instance, uuids created by other processes are added to it every
+    `bloom_refresh_interval` seconds (see
+    `conf.MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL`). Within this window
+    they are reported as missing, use `force=True` for exact checks.
 
     Examples::
 
@@ -30,39 +45,189 @@ class BaseSequence(Base):
         'foo' in seq
     """
     cache_size = None
-    clonable_attrs = ['cache_size']
-
-    def __init__(self, name, client='default', cache_size=None):
+    cache_ttl = None
+    bloom = None
+    bloom_error_rate = 0.01
+    # Refresh bloom filter when it's older than given number of seconds.
+    bloom_refresh_interval = None
+    clonable_attrs = ['cache_size', 'cache_ttl', 'bloom', 'bloom_error_rate',
+                      'bloom_refresh_interval']
+
+    def __init__(self, name, client='default', cache_size=None, cache_ttl=None):
         super(BaseSequence, self).__init__(name, client)
-        self.cache_size = cache_size or self.cache_size
+        self.cache_size = not_none(cache_size, self.cache_size)
+        self.cache_ttl = not_none(cache_ttl, self.cache_ttl)
 
     @property
     def cache(self):
-        if self.cache_size and lru:
+        cache_size = not_none(self.cache_size, conf.MOMENT_SEQUENCE_CACHE_SIZE)
+        if cache_size:
             if not hasattr(self, '_cache'):
-                self._cache = lru.LRU(self.cache_size)
+                cache_ttl = not_none(self.cache_ttl, conf.MOMENT_SEQUENCE_CACHE_TTL)
+                self._cache = LRUCache(cache_size, cache_ttl)
             return self._cache
 
+    def cache_stats(self):
+        cache = self.cache
+        return cache.stats() if cache is not None else None
+
+    def build_bloom(self, capacity=None, error_rate=None, count=1000):
+        """
+        (Re)builds bloom filter from the sequence storage using ZSCAN/HSCAN.
+        By default filter capacity is twice the current sequence size.
+        """
+        capacity = capacity or max(self.count() * 2, 1024)
+        error_rate = error_rate or self.bloom_error_rate
+        bloom = BloomFilter(capacity, error_rate)
+        next_id = 0
+        for uuid, sid in self.scan_iter(count):
+            bloom.add(uuid)
+            next_id = max(next_id, sid + 1)
+        self.bloom = bloom
+        self._bloom_state = (bloom, next_id, bloom.created)
+        return bloom
+
+    def refresh_bloom(self):
+        """
+        Adds uuids created since the last refresh to bloom filter, only new
+        ids are fetched when the storage allows it (see `_iter_new_uuids`),
+        otherwise the filter is rebuilt.
+        """
+        bloom, next_id, _ = getattr(self, '_bloom_state', (None, 0, 0))
+        new_uuids = None
+        if bloom is self.bloom:
+            new_uuids = self._iter_new_uuids(next_id)
+        if new_uuids is None:
+            return self.build_bloom(error_rate=self.bloom.error_rate)
+        for uuid, sid in new_uuids:
+            bloom.add(uuid)
+            next_id = max(next_id, sid + 1)
+        self._bloom_state = (bloom, next_id, time.time())
+        return bloom
+
+    def _iter_new_uuids(self, next_id):
+        """ Yields `(uuid, id)` pairs of ids not less than `next_id`. """
+        items = self.client.zrangebyscore(self.key, next_id, '+inf',
+                                          withscores=True)
+        return ((uuid, int(sid)) for uuid, sid in items)
+
+    def get_bloom(self):
+        """ Returns bloom filter, refreshes it if stale or saturated. """
+        bloom = self.bloom
+        if bloom is not None:
+            if bloom.is_saturated:
+                return self.build_bloom(error_rate=bloom.error_rate)
+            interval = not_none(self.bloom_refresh_interval,
+                                conf.MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL)
+            state = getattr(self, '_bloom_state', None)
+            refreshed = state[2] if state and state[0] is bloom \
+                else bloom.created
+            if interval and time.time() - refreshed > interval:
+                bloom = self.refresh_bloom()
+        return bloom
+
     def sequential_id(self, uuid, force=False):
+        return self.sequential_ids([uuid], force)[0]
+
+    def sequential_ids(self, uuids, force=False, create=True, setbit_keys=None,
+                       versions_key=None):
+        """
+        Resolves sequential ids for all `uuids` with a single script call,
+        cached ids are not requested again. When `create` is False unknown
+        uuids are mapped to `None` instead of allocating new ids. Optionally
+        sets bits for resolved ids in `setbit_keys` within the same call,
+        write versions of these bitmaps are incremented in `versions_key`
+        hash.
+
+        Examples::
+
+            seq = Sequence('sequence1')
+            seq.sequential_ids(['foo', 'bar']) == [0, 1]
+            seq.sequential_ids(['bar', 'baz'], create=False) == [1, None]
+        """
         cache = self.cache
-        if not force and cache:
-            try:
-                return cache[uuid]
-            except KeyError:
-                pass
-        new_id = _sequential_id(self.key, uuid, self.client)
-        if cache:
-            cache[uuid] = new_id
-        return new_id
+        ids = {}
+        # Bits should be set for all uuids, so cache doesn't help here.
+        if not force and not setbit_keys and cache is not None:
+            for uuid in uuids:
+                try:
+                    ids[uuid] = cache[uuid]
+                except KeyError:
+                    pass
+
+        missing = [uuid for uuid in uuids if uuid not in ids]
+        bloom = self.get_bloom()
+        if not create and bloom is not None:
+            for uuid in missing:
+                if uuid not in bloom:
+                    ids[uuid] = None
+            missing = [uuid for uuid in missing if uuid not in ids]
+
+        if missing:
+            new_ids = self._resolve_ids(missing, create, setbit_keys,
+                                        versions_key)
+            for uuid, new_id in zip(missing, new_ids):
+                if new_id is not None:
+                    new_id = int(new_id)
+                    if cache is not None:
+                        cache[uuid] = new_id
+                    if bloom is not None:
+                        bloom.add(uuid)
+                ids[uuid] = new_id
+
+        return [ids[uuid] for uuid in uuids]
+
+    def _resolve_ids(self, uuids, create=True, setbit_keys=None,
+                     versions_key=None):
+        if setbit_keys:
+            assert versions_key, '`versions_key` is required to set bits.'
+            keys = [self.key, versions_key] + list(setbit_keys)
+            return sequential_msetbit(keys=keys, args=uuids, client=self.client)
+        if create:
+            return monotonic_zadd_many(keys=[self.key], args=uuids,
+                                       client=self.client)
+        return zscore_many(keys=[self.key], args=uuids, client=self.client)
+
+    def uuids(self, ids):
+        """
+        Reverse lookup of uuids for given sequential ids with a single call.
+        Unknown ids are mapped to `None`.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        low, high = min(ids), max(ids)
+        if high - low < 2 * len(ids):
+            # Ids are dense enough to fetch the whole range at once.
+            items = self.client.zrangebyscore(self.key, low, high,
+                                              withscores=True)
+            mapping = dict((int(sid), uuid) for uuid, sid in items)
+            return [mapping.get(sid) for sid in ids]
+        with self.client.pipeline(transaction=False) as pipe:
+            for sid in ids:
+                pipe.zrangebyscore(self.key, sid, sid)
+            result = pipe.execute()
+        return [items[0] if items else None for items in result]
+
+    def scan_iter(self, count=None):
+        """ Iterates over `(uuid, sequential_id)` pairs. """
+        for uuid, sid in self.client.zscan_iter(self.key, count=count):
+            yield uuid, int(sid)
 
     def has_uuid(self, uuid, force=False):
         cache = self.cache
-        if not force and cache:
+        if not force and cache is not None:
             try:
                 # Is uuid was cached before?
                 return cache[uuid] is not None
             except KeyError:
                 pass
+        bloom = self.get_bloom()
+        if not force and bloom is not None and uuid not in bloom:
+            return False
+        return self._has_uuid(uuid)
+
+    def _has_uuid(self, uuid):
         # Seq id is zero-based.
         return self.client.zscore(self.key, uuid) is not None
 
@@ -72,6 +237,8 @@ class BaseSequence(Base):
     def delete(self):
         self.client.delete(self.key)
         self.flush_cache()
+        if self.bloom is not None:
+            self.bloom = BloomFilter(self.bloom.capacity, self.bloom.error_rate)
 
     def flush_cache(self):
         try:
@@ -86,8 +253,116 @@ class BaseSequence(Base):
         return self.count()
 
 
+class BaseHashSequence(BaseSequence):
+    """
+    Sequence which keeps `uuid -> id` mapping in a hash and allocates new
+    ids with a counter key. This takes much less memory than sorted set
+    backed `BaseSequence`. Optional reverse `id -> uuid` hash makes cheap
+    reverse lookups possible.
+
+    Examples::
+
+        seq = HashSequence('sequence1', reverse=True)
+        seq.sequential_ids(['foo', 'bar']) == [0, 1]
+        seq.uuids([1, 0]) == ['bar', 'foo']
+    """
+    reverse = False
+    clonable_attrs = ['reverse']
+
+    def __init__(self, name, client='default', cache_size=None, cache_ttl=None,
+                 reverse=None):
+        super(BaseHashSequence, self).__init__(name, client, cache_size,
+                                               cache_ttl)
+        self.reverse = not_none(reverse, self.reverse)
+
+    @property
+    def counter_key(self):
+        return '{0}:counter'.format(self.key)
+
+    @property
+    def reverse_key(self):
+        return '{0}:reverse'.format(self.key)
+
+    def _resolve_ids(self, uuids, create=True, setbit_keys=None,
+                     versions_key=None):
+        if not create and not setbit_keys:
+            return self.client.hmget(self.key, uuids)
+        keys = [self.key, self.counter_key, self.reverse_key]
+        args = [1 if self.reverse else 0] + list(uuids)
+        if setbit_keys:
+            assert versions_key, '`versions_key` is required to set bits.'
+            keys = keys + [versions_key] + list(setbit_keys)
+            return hash_sequential_msetbit(keys=keys, args=args,
+                                           client=self.client)
+        return hash_sequential_ids(keys=keys, args=args, client=self.client)
+
+    def uuids(self, ids):
+        if not self.reverse:
+            raise LookupError("Reverse mapping is disabled for `{0}`, "
+                              "use `reverse=True`.".format(self.name))
+        ids = list(ids)
+        if not ids:
+            return []
+        return self.client.hmget(self.reverse_key, ids)
+
+    def scan_iter(self, count=None):
+        for uuid, sid in self.client.hscan_iter(self.key, count=count):
+            yield uuid, int(sid)
+
+    def _iter_new_uuids(self, next_id):
+        # New uuids can be found only by the reverse mapping.
+        if not self.reverse:
+            return None
+        counter = int(self.client.get(self.counter_key) or 0)
+        if counter <= next_id:
+            return iter([])
+        ids = list(range(next_id, counter))
+        uuids = self.client.hmget(self.reverse_key, ids)
+        return ((uuid, sid) for uuid, sid in zip(uuids, ids)
+                if uuid is not None)
+
+    def _has_uuid(self, uuid):
+        return self.client.hexists(self.key, uuid)
+
+    def count(self):
+        return self.client.hlen(self.key)
+
+    def delete(self):
+        self.client.delete(self.counter_key, self.reverse_key)
+        super(BaseHashSequence, self).delete()
+
+    def migrate_from(self, sequence, batch_size=1000):
+        """
+        Copies `uuid -> id` mapping from sorted set backed `sequence` keeping
+        ids the same, so existing bitmaps remain valid. Writers of both
+        sequences should be stopped while migration is in progress.
+        """
+        max_id = -1
+        batch = []
+        for uuid, sid in sequence.scan_iter(batch_size):
+            max_id = max(max_id, sid)
+            batch.append((uuid, sid))
+            if len(batch) >= batch_size:
+                self._migrate_batch(batch)
+                batch = []
+        if batch:
+            self._migrate_batch(batch)
+        self.client.set(self.counter_key, max_id + 1)
+        self.flush_cache()
+        return max_id + 1
+
+    def _migrate_batch(self, batch):
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.hmset(self.key, dict(batch))
+            if self.reverse:
+                pipe.hmset(self.reverse_key, dict((i, u) for u, i in batch))
+            pipe.execute()
+
+
 class BaseDict(MixinSerializable, Base):
     clonable_attrs = ['serializer']
+    # Default COUNT hint of HSCAN used by lazy iterators.
+    scan_count = None
 
     def __init__(self, name, client='default', serializer=None):
         super(BaseDict, self).__init__(name, client)
@@ -121,18 +396,25 @@ class BaseDict(MixinSerializable, Base):
             return self.loads(value)
         return default
 
+    def get_many(self, keys, default=None):
+        """ Returns values of `keys` (or `default`) by a single HMGET. """
+        keys = list(keys)
+        if not keys:
+            return []
+        values = self.client.hmget(self.key, keys)
+        return [self.loads(v) if v is not None else default for v in values]
+
     def update(self, *args, **kwargs):
-        for o in args:
-            self._update(o)
-        self._update(kwargs)
-
-    def _update(self, other):
-        if hasattr(other, 'items'):
-            for k, v in other.items():
-                self[k] = v
-        else:
-            for k, v in other:
-                self[k] = v
+        """ Sets all values by a single HMSET. """
+        mapping = {}
+        for other in args + (kwargs,):
+            items = other.items() if hasattr(other, 'items') else other
+            for k, v in items:
+                mapping[k] = v
+        if mapping:
+            dumps = self.dumps
+            self.client.hmset(self.key, dict((k, dumps(v))
+                                             for k, v in mapping.items()))
 
     def keys(self):
         return self.client.hkeys(self.key)
@@ -144,19 +426,30 @@ class BaseDict(MixinSerializable, Base):
         data = self.client.hgetall(self.key)
         return [(k, self.loads(v)) for k, v in data.items()]
 
-    def iterkeys(self):
-        return iter(self.keys())
+    def _scan_iter(self, count=None):
+        return self.client.hscan_iter(self.key, count=count or self.scan_count)
+
+    def iterkeys(self, count=None):
+        """
+        Lazy iterators fetch items by HSCAN with `count` hint, so they don't
+        block redis for big hashes. Items changed during iteration may be
+        skipped or repeated.
+        """
+        for k, _ in self._scan_iter(count):
+            yield k
 
-    def itervalues(self):
-        return iter(self.values())
+    def itervalues(self, count=None):
+        for _, v in self._scan_iter(count):
+            yield self.loads(v)
 
-    def iteritems(self):
-        return iter(self.items())
+    def iteritems(self, count=None):
+        for k, v in self._scan_iter(count):
+            yield k, self.loads(v)
 
     def setdefault(self, key, value=None):
-        if self.client.hsetnx(self.key, key, self.dumps(value)) == 1:
-            return value
-        return self.get(key)
+        value = hsetdefault(keys=[self.key], args=[key, self.dumps(value)],
+                            client=self.client)
+        return self.loads(value)
 
     def has_key(self, key):
         return key in self
@@ -168,13 +461,8 @@ class BaseDict(MixinSerializable, Base):
         self.delete()
 
     def pop(self, key, default=_NONE):
-
-        with self.client.pipeline() as pipe:
-            pipe.hget(self.key, key)
-            pipe.hdel(self.key, key)
-            value, existed = pipe.execute()
-
-        if not existed:
+        value = hpop(keys=[self.key], args=[key], client=self.client)
+        if value is None:
             if default is _NONE:
                 raise KeyError(key)
             return default
@@ -182,9 +470,14 @@ class BaseDict(MixinSerializable, Base):
 
 
 class BaseCounter(BaseDict):
+    clonable_attrs = ['buffer']
+    # Optional `CounterBuffer` to aggregate increments in memory.
+    buffer = None
 
-    def __init__(self, name, client='default', serializer=None):
+    def __init__(self, name, client='default', serializer=None, buffer=None):
         super(BaseCounter, self).__init__(name, client, None)
+        if buffer is not None:
+            self.buffer = buffer
 
     def dumps(self, value):
         return str(int(value))
@@ -199,19 +492,33 @@ class BaseCounter(BaseDict):
 
     def _merge(self, iterable=None, **kwargs):
         if iterable:
-            try:
-                items = iterable.iteritems()
-            except AttributeError:
+            items = getattr(iterable, 'iteritems', None) or \
+                getattr(iterable, 'items', None)
+            if items is None:
                 for k in iterable:
                     kwargs[k] = kwargs.get(k, 0) + 1
             else:
-                for k, v in items:
+                for k, v in items():
                     kwargs[k] = kwargs.get(k, 0) + v
         return kwargs.items()
 
-    def _update(self, iterable, multiplier, **kwargs):
+    def _update(self, iterable, multiplier, pipe=None, **kwargs):
+        """
+        Increments all fields by a single pipeline, or queues increments
+        into the given `pipe` to be executed by the caller. Increments are
+        added to the counter `buffer` instead, if there is one.
+        """
+        if pipe is None and self.buffer is not None:
+            items = self._merge(iterable, **kwargs)
+            self.buffer.add(self.client, self.key,
+                            [(k, v * multiplier) for k, v in items])
+            return
+        client = pipe if pipe is not None else \
+            self.client.pipeline(transaction=False)
         for k, v in self._merge(iterable, **kwargs):
-            self.client.hincrby(self.key, k, v * multiplier)
+            client.hincrby(self.key, k, v * multiplier)
+        if pipe is None:
+            client.execute()
 
     def update(self, iterable=None, **kwargs):
         self._update(iterable, 1, **kwargs)
@@ -251,7 +558,7 @@ class BaseCounter(BaseDict):
         return values
 
     def total(self):
-        return sum(self.values())
+        return sum(self.itervalues())
 
     def __iadd__(self, other):
         self.update(other)
@@ -268,3 +575,139 @@ class BaseCounter(BaseDict):
     def __ior__(self, other):
         self.union_update(other)
         return self
+
+
+class BaseRankedCounter(BaseCounter):
+    """
+    Counter backed by a sorted set, so top-N counts are selected by redis
+    and only N items are transferred. Total of all counts is maintained in
+    a separate `total_key`. Has the same API as `BaseCounter`, but can't
+    be used with `CounterBuffer`.
+
+    Examples::
+
+        counter = RankedDayCounter('referrers')
+        counter.update(['google.com', 'bing.com', 'google.com'])
+        counter.most_common(10) == [(b'google.com', 2), (b'bing.com', 1)]
+        counter.total() == 3
+    """
+
+    @property
+    def total_key(self):
+        return '{0}:total'.format(self.key)
+
+    def __len__(self):
+        return self.client.zcard(self.key)
+
+    def __contains__(self, key):
+        return self.client.zscore(self.key, key) is not None
+
+    def __setitem__(self, key, value):
+        ranked_counter_set(keys=[self.key, self.total_key],
+                           args=['set', key, self.dumps(value)],
+                           client=self.client)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def get(self, key, default=None):
+        value = self.client.zscore(self.key, key)
+        if value is not None:
+            return self.loads(value)
+        return default
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        if not keys:
+            return []
+        values = zscore_many(keys=[self.key], args=keys, client=self.client)
+        return [self.loads(v) if v is not None else default for v in values]
+
+    def loads(self, value):
+        return int(float(value))
+
+    def _update(self, iterable, multiplier, pipe=None, **kwargs):
+        """
+        Increments all fields and the total by a single MULTI/EXEC pipeline,
+        or queues increments into the given `pipe`.
+        """
+        if self.buffer is not None:
+            raise NotImplementedError(
+                "`{0}` doesn't support buffering.".format(
+                    self.__class__.__name__))
+        items = [(k, v * multiplier) for k, v in self._merge(iterable, **kwargs)]
+        if not items:
+            return
+        client = pipe if pipe is not None else \
+            self.client.pipeline(transaction=True)
+        for k, v in items:
+            client.zincrby(self.key, k, v)
+        client.incrby(self.total_key, sum(v for _, v in items))
+        if pipe is None:
+            client.execute()
+
+    def intersection_update(self, iterable=None, **kwargs):
+        args = ['intersection'] + list(self._flatten(iterable, **kwargs))
+        ranked_counter_multiset_update(keys=[self.key, self.total_key],
+                                       args=args, client=self.client)
+
+    def union_update(self, iterable=None, **kwargs):
+        args = ['union'] + list(self._flatten(iterable, **kwargs))
+        ranked_counter_multiset_update(keys=[self.key, self.total_key],
+                                       args=args, client=self.client)
+
+    def _scan_iter(self, count=None):
+        return self.client.zscan_iter(self.key, count=count or self.scan_count)
+
+    def keys(self):
+        return self.client.zrange(self.key, 0, -1)
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def items(self):
+        data = self.client.zrange(self.key, 0, -1, withscores=True)
+        return [(k, self.loads(v)) for k, v in data]
+
+    def setdefault(self, key, value=None):
+        value = ranked_counter_set(keys=[self.key, self.total_key],
+                                   args=['nx', key, self.dumps(value or 0)],
+                                   client=self.client)
+        return self.loads(value)
+
+    def pop(self, key, default=_NONE):
+        value = ranked_counter_pop(keys=[self.key, self.total_key],
+                                   args=[key], client=self.client)
+        if value is None:
+            if default is _NONE:
+                raise KeyError(key)
+            return default
+        return self.loads(value)
+
+    def most_common(self, n=None):
+        data = self.client.zrevrange(self.key, 0, (n or 0) - 1,
+                                     withscores=True)
+        return [(k, self.loads(v)) for k, v in data]
+
+    def most_common_percent(self, n=None, precision=None):
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.zrevrange(self.key, 0, (n or 0) - 1, withscores=True)
+            pipe.get(self.total_key)
+            data, total = pipe.execute()
+        total = float(total or 0)
+        values = [(k, self.loads(v) / total * 100) for k, v in data]
+        if precision is not None:
+            values = [(k, round(v, precision)) for k, v in values]
+        return values
+
+    def total(self):
+        return int(self.client.get(self.total_key) or 0)
+
+    def delete(self):
+        self.client.delete(self.key, self.total_key)
+
+    def expire(self, ttl):
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.expire(self.key, ttl)
+            pipe.expire(self.total_key, ttl)
+            pipe.execute()
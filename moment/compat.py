@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-__all__ = ['lru', 'msgpack', 'json', 'pickle', 'pickle_hi']
+__all__ = ['msgpack', 'numpy', 'lz4_frame', 'zstandard', 'json', 'pickle',
+           'pickle_hi', 'basestring']
+
+
+try:
+    basestring = basestring
+except NameError:
+    basestring = str  # noqa
 
 
 try:
@@ -10,9 +17,19 @@ except ImportError:
     msgpack = None  # noqa
 
 try:
-    import lru
+    import numpy
+except ImportError:
+    numpy = None  # noqa
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None  # noqa
+
+try:
+    import zstandard
 except ImportError:
-    lru = None  # noqa
+    zstandard = None  # noqa
 
 try:
     import ujson as json
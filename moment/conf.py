@@ -7,6 +7,7 @@ from redis.connection import PythonParser
 from redis.connection import ConnectionPool
 
 from .compat import json, pickle_hi, pickle, msgpack
+from .serializers import CompressedSerializer
 
 
 __all__ = ['get_serializer', 'register_connection', 'get_connection']
@@ -15,6 +16,40 @@ __all__ = ['get_serializer', 'register_connection', 'get_connection']
 MOMENT_KEY_PREFIX = 'spm'
 MOMENT_SERIALIZER = 'json'
 
+# Max number of uuids sent to redis in a single `record_events` script call.
+MOMENT_RECORD_CHUNK_SIZE = 1000
+
+# Size of bitmap chunks (in bytes) fetched by `Event.members()`.
+MOMENT_BITMAP_CHUNK_SIZE = 65536
+
+# Reuse results of bit operations while their operands are not changed.
+MOMENT_BITOP_CACHE = False
+
+# Time to live (in seconds) of keys created by bit operations, 0 - no ttl.
+MOMENT_BITOP_TTL = 3600
+
+# Default `rollup` flag of events: include finer periods recorded with
+# `record_events(..., rollup=True)` and not rolled up yet, so reads are exact
+# before `rollup_events()` at the cost of a pending keys lookup per read.
+MOMENT_EVENT_ROLLUP = False
+
+# Default size and ttl (in seconds) of local sequential ids cache.
+MOMENT_SEQUENCE_CACHE_SIZE = 100000
+MOMENT_SEQUENCE_CACHE_TTL = None
+
+# Max age (in seconds, 0 - until saturated) of sequence bloom filter, after
+# which uuids created by other processes are added to it.
+MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL = 60
+
+# Max number of buffered fields and flush interval (in seconds, 0 - flush
+# only explicitly or when buffer is full) of `CounterBuffer`.
+MOMENT_COUNTER_BUFFER_SIZE = 10000
+MOMENT_COUNTER_BUFFER_INTERVAL = 1.0
+
+
+# Store timeline items without duplicated timestamp (see `Timeline`).
+MOMENT_TIMELINE_COMPACT = False
+
 
 _serializers = {
     'json': json,
@@ -24,6 +59,10 @@ _serializers = {
 if msgpack:
     _serializers['msgpack'] = msgpack
 
+# Compressed variants, see `serializers.CompressedSerializer`.
+_serializers.update([(alias + '_zlib', CompressedSerializer(serializer))
+                     for alias, serializer in list(_serializers.items())])
+
 
 def get_serializer(alias):
     alias = alias or MOMENT_SERIALIZER
@@ -11,6 +11,17 @@ Integration with django settings:
 
 MOMENT_KEY_PREFIX = 'spm'
 MOMENT_SERIALIZER = 'msgpack'
+MOMENT_RECORD_CHUNK_SIZE = 1000
+MOMENT_BITMAP_CHUNK_SIZE = 65536
+MOMENT_BITOP_CACHE = True
+MOMENT_BITOP_TTL = 3600
+MOMENT_SEQUENCE_CACHE_SIZE = 100000
+MOMENT_SEQUENCE_CACHE_TTL = 3600
+MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL = 60
+MOMENT_COUNTER_BUFFER_SIZE = 10000
+MOMENT_COUNTER_BUFFER_INTERVAL = 1.0
+MOMENT_TIMELINE_COMPACT = True
+MOMENT_EVENT_ROLLUP = True
 MOMENT_REDIS = {
     'default': {
         'host': 'localhost',
@@ -31,6 +42,17 @@ from django.conf import settings
 MOMENT_REDIS = getattr(settings, 'MOMENT_REDIS', None)
 MOMENT_KEY_PREFIX = getattr(settings, 'MOMENT_KEY_PREFIX', None)
 MOMENT_SERIALIZER = getattr(settings, 'MOMENT_SERIALIZER', None)
+MOMENT_RECORD_CHUNK_SIZE = getattr(settings, 'MOMENT_RECORD_CHUNK_SIZE', None)
+MOMENT_BITMAP_CHUNK_SIZE = getattr(settings, 'MOMENT_BITMAP_CHUNK_SIZE', None)
+MOMENT_BITOP_CACHE = getattr(settings, 'MOMENT_BITOP_CACHE', None)
+MOMENT_BITOP_TTL = getattr(settings, 'MOMENT_BITOP_TTL', None)
+MOMENT_SEQUENCE_CACHE_SIZE = getattr(settings, 'MOMENT_SEQUENCE_CACHE_SIZE', None)
+MOMENT_SEQUENCE_CACHE_TTL = getattr(settings, 'MOMENT_SEQUENCE_CACHE_TTL', None)
+MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL = getattr(settings, 'MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL', None)
+MOMENT_COUNTER_BUFFER_SIZE = getattr(settings, 'MOMENT_COUNTER_BUFFER_SIZE', None)
+MOMENT_COUNTER_BUFFER_INTERVAL = getattr(settings, 'MOMENT_COUNTER_BUFFER_INTERVAL', None)
+MOMENT_TIMELINE_COMPACT = getattr(settings, 'MOMENT_TIMELINE_COMPACT', None)
+MOMENT_EVENT_ROLLUP = getattr(settings, 'MOMENT_EVENT_ROLLUP', None)
 
 
 if MOMENT_KEY_PREFIX:
@@ -39,6 +61,43 @@ if MOMENT_KEY_PREFIX:
 if MOMENT_SERIALIZER:
     conf.MOMENT_SERIALIZER = MOMENT_SERIALIZER
 
+if MOMENT_RECORD_CHUNK_SIZE:
+    conf.MOMENT_RECORD_CHUNK_SIZE = MOMENT_RECORD_CHUNK_SIZE
+
+if MOMENT_BITMAP_CHUNK_SIZE is not None:
+    conf.MOMENT_BITMAP_CHUNK_SIZE = MOMENT_BITMAP_CHUNK_SIZE
+
+if MOMENT_BITOP_CACHE is not None:
+    conf.MOMENT_BITOP_CACHE = MOMENT_BITOP_CACHE
+
+# Zero ttl is allowed and keeps bitop keys until deleted explicitly.
+if MOMENT_BITOP_TTL is not None:
+    conf.MOMENT_BITOP_TTL = MOMENT_BITOP_TTL
+
+# Zero cache size is allowed and disables sequences cache.
+if MOMENT_SEQUENCE_CACHE_SIZE is not None:
+    conf.MOMENT_SEQUENCE_CACHE_SIZE = MOMENT_SEQUENCE_CACHE_SIZE
+
+if MOMENT_SEQUENCE_CACHE_TTL:
+    conf.MOMENT_SEQUENCE_CACHE_TTL = MOMENT_SEQUENCE_CACHE_TTL
+
+# Zero interval is allowed and disables bloom filter refresh.
+if MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL is not None:
+    conf.MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL = MOMENT_SEQUENCE_BLOOM_REFRESH_INTERVAL
+
+if MOMENT_COUNTER_BUFFER_SIZE:
+    conf.MOMENT_COUNTER_BUFFER_SIZE = MOMENT_COUNTER_BUFFER_SIZE
+
+# Zero interval is allowed and disables background flushes.
+if MOMENT_COUNTER_BUFFER_INTERVAL is not None:
+    conf.MOMENT_COUNTER_BUFFER_INTERVAL = MOMENT_COUNTER_BUFFER_INTERVAL
+
+if MOMENT_TIMELINE_COMPACT is not None:
+    conf.MOMENT_TIMELINE_COMPACT = MOMENT_TIMELINE_COMPACT
+
+if MOMENT_EVENT_ROLLUP is not None:
+    conf.MOMENT_EVENT_ROLLUP = MOMENT_EVENT_ROLLUP
+
 if MOMENT_REDIS:
     for alias, conn_conf in MOMENT_REDIS.items():
         conf.register_connection(alias, **conn_conf)
@@ -4,29 +4,43 @@
 import itertools
 from datetime import datetime
 from . import conf
-from .collections import BaseCounter
-from .base import BaseHour, BaseDay, BaseWeek, BaseMonth, BaseYear
+from .collections import BaseCounter, BaseRankedCounter
+from .compat import basestring
+from .base import (
+    _key, MixinPeriod, BaseHour, BaseDay, BaseWeek, BaseMonth, BaseYear
+)
+from .lua import counters_range_top
 
-__all__ = ['COUNTER_NAMESPACE', 'COUNTER_ALIASES', 'update_counters',
-           'Counter', 'HourCounter', 'DayCounter', 'WeekCounter',
-           'MonthCounter', 'YearCounter']
+__all__ = ['COUNTER_NAMESPACE', 'COUNTER_ALIASES', 'RANKED_COUNTER_NAMESPACE',
+           'RANKED_COUNTER_ALIASES', 'update_counters', 'Counter',
+           'HourCounter', 'DayCounter', 'WeekCounter', 'MonthCounter',
+           'YearCounter', 'RankedCounter', 'RankedHourCounter',
+           'RankedDayCounter', 'RankedWeekCounter', 'RankedMonthCounter',
+           'RankedYearCounter']
 
 
 COUNTER_NAMESPACE = 'cnt'
+RANKED_COUNTER_NAMESPACE = 'rcnt'
 
 
 def update_counters(counter_names, iterable=None, counter_types=None, dt=None,
-                    client='default'):
+                    client='default', atomic=False, buffer=None):
     """
     Updates counters for hours, days, weeks and months. Default counter
     type is `Day`.
 
+    All counters are updated by a single pipeline. With `atomic` pipeline
+    is wrapped into MULTI/EXEC, so other clients never see partial update.
+    With `buffer` (or counter types with default buffer) increments are
+    aggregated in memory by `CounterBuffer` and written on its flush.
+
     Examples::
 
         update_counters('counter1', {'value1': 1, 'value2': 1})
         update_counters(['counter1', 'counter2'], {'value1': 2, 'value2': 3})
         update_counters(['counter1', 'counter2'], ['value1', 'value2'])
         update_counters('counter1', 'value1')
+        update_counters('counter1', 'value1', ['day', 'month'], atomic=True)
     """
     client = conf.get_connection(client)
 
@@ -48,21 +62,65 @@ def update_counters(counter_names, iterable=None, counter_types=None, dt=None,
     if dt is None:
         dt = datetime.utcnow()
 
-    # TODO: use pipe and multi commands
     counters = []
     for name, cn_type in itertools.product(counter_names, counter_types):
         counters.append(cn_type.from_date(name, dt, client))
 
-    for counter in counters:
-        counter.update(iterable)
+    if counters:
+        # Merged once, `iterable` may be a generator.
+        values = dict(counters[0]._merge(iterable))
+        with client.pipeline(transaction=atomic) as pipe:
+            for counter in counters:
+                if buffer is not None:
+                    counter.buffer = buffer
+                if counter.buffer is not None:
+                    counter._update(values, 1)
+                else:
+                    counter._update(values, 1, pipe)
+            pipe.execute()
 
     return counters
 
 
+def _most_common_range(counter_type, name, start, end, n, client, ttl):
+    client = conf.get_connection(client)
+    keys = list(counter_type.period_keys(name, start, end))
+    if not keys:
+        return []
+    source = 'zset' if issubclass(counter_type, BaseRankedCounter) else 'hash'
+    dest = _key('range_top:({0}~{1})'.format(keys[0], keys[-1]),
+                counter_type.namespace)
+    data = counters_range_top(keys=keys + [dest],
+                              args=[source, n or 0, ttl or 0], client=client)
+    return [(k, int(float(v))) for k, v in zip(data[::2], data[1::2])]
+
+
 class Counter(BaseCounter):
     namespace = COUNTER_NAMESPACE
     key_format = '{self.name}'
 
+    @classmethod
+    def most_common_range(cls, name, start, end, n=None, period=None,
+                          client='default', ttl=None):
+        """
+        Top `n` items of `name` counters summed over all periods between
+        `start` and `end` (inclusive). Counters are summed by a single script
+        call and only top items are transferred. With `ttl` the sum is kept
+        for `ttl` seconds and reused by the next calls with the same range.
+        Period defaults to the class period or day.
+
+        Examples::
+
+            end = datetime.utcnow()
+            Counter.most_common_range('pages', end - timedelta(days=89), end, 10)
+            DayCounter.most_common_range('pages', start, end, 10, ttl=600)
+            RankedCounter.most_common_range('pages', start, end, 10, 'week')
+        """
+        if period is None:
+            period = cls if issubclass(cls, MixinPeriod) else 'day'
+        counter_type = COUNTER_ALIASES.get(period, period)
+        return _most_common_range(counter_type, name, start, end, n, client, ttl)
+
 
 class HourCounter(BaseHour, Counter):
     pass
@@ -84,6 +142,40 @@ class YearCounter(BaseYear, Counter):
     pass
 
 
+class RankedCounter(BaseRankedCounter):
+    namespace = RANKED_COUNTER_NAMESPACE
+    key_format = '{self.name}'
+
+    @classmethod
+    def most_common_range(cls, name, start, end, n=None, period=None,
+                          client='default', ttl=None):
+        """ See `Counter.most_common_range()`, sums are done by ZUNIONSTORE. """
+        if period is None:
+            period = cls if issubclass(cls, MixinPeriod) else 'day'
+        counter_type = RANKED_COUNTER_ALIASES.get(period, period)
+        return _most_common_range(counter_type, name, start, end, n, client, ttl)
+
+
+class RankedHourCounter(BaseHour, RankedCounter):
+    pass
+
+
+class RankedDayCounter(BaseDay, RankedCounter):
+    pass
+
+
+class RankedWeekCounter(BaseWeek, RankedCounter):
+    pass
+
+
+class RankedMonthCounter(BaseMonth, RankedCounter):
+    pass
+
+
+class RankedYearCounter(BaseYear, RankedCounter):
+    pass
+
+
 COUNTER_ALIASES = {
     'hour': HourCounter,
     'day': DayCounter,
@@ -91,3 +183,11 @@ COUNTER_ALIASES = {
     'month': MonthCounter,
     'year': YearCounter,
 }
+
+RANKED_COUNTER_ALIASES = {
+    'hour': RankedHourCounter,
+    'day': RankedDayCounter,
+    'week': RankedWeekCounter,
+    'month': RankedMonthCounter,
+    'year': RankedYearCounter,
+}
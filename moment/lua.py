@@ -1,7 +1,13 @@
 
 
-__all__ = ['LazzyScript', 'monotonic_zadd', 'sequential_id', 'msetbit',
-           'multiset_union_update', 'multiset_intersection_update']
+__all__ = ['LazzyScript', 'monotonic_zadd', 'monotonic_zadd_many',
+           'zscore_many', 'sequential_id', 'sequential_ids', 'msetbit',
+           'msetbits', 'sequential_msetbit', 'hash_sequential_ids',
+           'hash_sequential_msetbit', 'bitop_eval', 'bitop_and_counts',
+           'bitop_funnel', 'rollup_or', 'multiset_union_update',
+           'multiset_intersection_update', 'ranked_counter_set',
+           'ranked_counter_pop', 'ranked_counter_multiset_update',
+           'counters_range_top', 'hsetdefault', 'hpop', 'capped_zadd']
 
 
 class LazzyScript(object):
@@ -39,11 +45,96 @@ monotonic_zadd = LazzyScript("""
 """)
 
 
+# Resolves ids for all ARGV uuids into `ids` table, allocating missing ones.
+_monotonic_zadd_many = """
+    local ids = {}
+    local next_id = redis.call('zcard', KEYS[1])
+    for index, uuid in ipairs(ARGV) do
+        local sequential_id = redis.call('zscore', KEYS[1], uuid)
+        if not sequential_id then
+            sequential_id = next_id
+            next_id = next_id + 1
+            redis.call('zadd', KEYS[1], sequential_id, uuid)
+        end
+        ids[index] = tonumber(sequential_id)
+    end
+"""
+
+
+monotonic_zadd_many = LazzyScript(_monotonic_zadd_many + """
+    return ids
+""")
+
+
+# Sets bits for resolved `ids` in KEYS after versions hash KEYS[%(index)s] and
+# increments write versions of updated bitmaps.
+_msetbit_ids = """
+    for i = %(index)s + 1, #KEYS do
+        for _, sequential_id in ipairs(ids) do
+            redis.call('setbit', KEYS[i], sequential_id, 1)
+        end
+        redis.call('hincrby', KEYS[%(index)s], KEYS[i], 1)
+    end
+    return ids
+"""
+
+
+# KEYS[1] is a sequence key, KEYS[2] is versions hash, the rest are bitmaps
+# to set; ARGV are uuids.
+sequential_msetbit = LazzyScript(
+    _monotonic_zadd_many + _msetbit_ids % {'index': 2})
+
+
+# KEYS[1..3] are forward hash, counter and reverse hash keys. ARGV[1] is
+# reverse mapping flag, the rest are uuids.
+_hash_sequential_ids = """
+    local ids = {}
+    local reverse = ARGV[1] == '1'
+    for index = 2, #ARGV do
+        local uuid = ARGV[index]
+        local sequential_id = redis.call('hget', KEYS[1], uuid)
+        if not sequential_id then
+            sequential_id = redis.call('incr', KEYS[2]) - 1
+            redis.call('hset', KEYS[1], uuid, sequential_id)
+            if reverse then
+                redis.call('hset', KEYS[3], sequential_id, uuid)
+            end
+        end
+        ids[index - 1] = tonumber(sequential_id)
+    end
+"""
+
+
+hash_sequential_ids = LazzyScript(_hash_sequential_ids + """
+    return ids
+""")
+
+
+# KEYS[4] is versions hash, the rest are bitmaps to set.
+hash_sequential_msetbit = LazzyScript(
+    _hash_sequential_ids + _msetbit_ids % {'index': 4})
+
+
+zscore_many = LazzyScript("""
+    local scores = {}
+    for index, value in ipairs(ARGV) do
+        scores[index] = redis.call('zscore', KEYS[1], value)
+    end
+    return scores
+""")
+
+
 def sequential_id(key, identifier, client=None):
     """Map an arbitrary string identifier to a set of sequential ids"""
     return int(monotonic_zadd(keys=[key], args=[identifier], client=client))
 
 
+def sequential_ids(key, identifiers, client=None):
+    """Bulk version of `sequential_id`, all ids are mapped in a single call"""
+    ids = monotonic_zadd_many(keys=[key], args=identifiers, client=client)
+    return [int(i) for i in ids]
+
+
 msetbit = LazzyScript("""
     for index, value in ipairs(KEYS) do
         redis.call('setbit', value, ARGV[(index - 1) * 2 + 1], ARGV[(index - 1) * 2 + 2])
@@ -52,6 +143,200 @@ msetbit = LazzyScript("""
 """)
 
 
+# KEYS[1] is versions hash, the rest are bitmaps to set; ARGV are offsets.
+msetbits = LazzyScript("""
+    local ids = ARGV
+""" + _msetbit_ids % {'index': 1})
+
+
+# Evaluates bit operations tree given in postfix notation. KEYS are leaf
+# bitmaps followed by versions hash, fingerprints hash and destination key.
+# ARGV[1] is evaluation mode: `store` saves result into destination key,
+# `count` counts set bits without storing anything. ARGV[2] enables result
+# cache: stored result is reused while write versions of leaves are the same
+# (also in `count` mode, which stores result for the next calls). ARGV[3] is
+# ttl of stored result (0 - no ttl). The rest of ARGV are `(op, arg)` pairs: `KEY i` pushes i-th key, `AND/OR/XOR/NOT/
+# _LDIFF n` pops n operands. Returns `{cache hit, count}`. Keys are passed to
+# HMGET and BITOP by slices, `unpack` of all of them may overflow Lua stack.
+bitop_eval = LazzyScript("""
+    local dest = KEYS[#KEYS]
+    local versions, fingerprints = KEYS[#KEYS - 2], KEYS[#KEYS - 1]
+    local mode, cache, ttl = ARGV[1], ARGV[2] == '1', tonumber(ARGV[3])
+    local slice = 1000
+
+    -- AND, OR and XOR are associative, so operands are folded by slices.
+    local function bitop(op, result, operands)
+        redis.call('bitop', op, result,
+                   unpack(operands, 1, math.min(slice, #operands)))
+        for i = slice + 1, #operands, slice - 1 do
+            local last = math.min(i + slice - 2, #operands)
+            redis.call('bitop', op, result, result, unpack(operands, i, last))
+        end
+    end
+
+    local fingerprint
+    if cache then
+        local values = {}
+        for i = 1, #KEYS - 3, slice do
+            local last = math.min(i + slice - 1, #KEYS - 3)
+            local part = redis.call('hmget', versions, unpack(KEYS, i, last))
+            for j = 1, #part do
+                values[#values + 1] = part[j] or '0'
+            end
+        end
+        fingerprint = table.concat(values, ':')
+        -- Empty results are not stored, so keep this in the fingerprint.
+        local cached = redis.call('hget', fingerprints, dest)
+        local exists = redis.call('exists', dest) == 1
+        if (exists and cached == fingerprint .. '|1') or
+                (not exists and cached == fingerprint .. '|0') then
+            if exists and ttl > 0 then
+                redis.call('expire', dest, ttl)
+            end
+            local count = 0
+            if mode == 'count' and exists then
+                count = redis.call('bitcount', dest)
+            end
+            return {1, count}
+        end
+    end
+
+    local stack, temporary = {}, {}
+    local n = 0
+    for i = 4, #ARGV, 2 do
+        local op, arg = ARGV[i], tonumber(ARGV[i + 1])
+        if op == 'KEY' then
+            stack[#stack + 1] = KEYS[arg]
+        else
+            local operands = {}
+            for j = #stack - arg + 1, #stack do
+                operands[#operands + 1] = stack[j]
+                stack[j] = nil
+            end
+            n = n + 1
+            local result = dest .. ':' .. n
+            if op == '_LDIFF' then
+                -- A - (B & C) == A ^ (A & B & C), exact for any bitmap lengths.
+                bitop('AND', result, operands)
+                redis.call('bitop', 'XOR', result, operands[1], result)
+            else
+                bitop(op, result, operands)
+            end
+            for _, key in ipairs(operands) do
+                if temporary[key] then
+                    redis.call('del', key)
+                    temporary[key] = nil
+                end
+            end
+            temporary[result] = true
+            stack[#stack + 1] = result
+        end
+    end
+
+    local result = stack[1]
+    local count = 0
+    if mode == 'count' then
+        count = redis.call('bitcount', result)
+    end
+    if mode == 'store' or cache then
+        local exists = redis.call('exists', result)
+        if exists == 1 then
+            redis.call('rename', result, dest)
+            if ttl > 0 then
+                redis.call('expire', dest, ttl)
+            end
+        else
+            redis.call('del', dest)
+        end
+        if cache then
+            redis.call('hincrby', versions, dest, 1)
+            redis.call('hset', fingerprints, dest, fingerprint .. '|' .. exists)
+        end
+    elseif temporary[result] then
+        redis.call('del', result)
+    end
+    return {0, count}
+""")
+
+
+# Counts members of AND of operand pairs. KEYS are operands followed by the
+# temporary key, ARGV are pairs of operand indexes. Nothing is stored.
+bitop_and_counts = LazzyScript("""
+    local temporary = KEYS[#KEYS]
+    local counts = {}
+    for i = 1, #ARGV, 2 do
+        local left, right = KEYS[tonumber(ARGV[i])], KEYS[tonumber(ARGV[i + 1])]
+        redis.call('bitop', 'AND', temporary, left, right)
+        counts[#counts + 1] = redis.call('bitcount', temporary)
+    end
+    redis.call('del', temporary)
+    return counts
+""")
+
+
+# Counts members of running intersection of funnel steps. KEYS are steps
+# followed by the temporary key. Nothing is stored.
+bitop_funnel = LazzyScript("""
+    local temporary = KEYS[#KEYS]
+    local counts = {redis.call('bitcount', KEYS[1])}
+    local current = KEYS[1]
+    for i = 2, #KEYS - 1 do
+        if counts[i - 1] == 0 then
+            counts[i] = 0
+        else
+            redis.call('bitop', 'AND', temporary, current, KEYS[i])
+            current = temporary
+            counts[i] = redis.call('bitcount', temporary)
+        end
+    end
+    redis.call('del', temporary)
+    return counts
+""")
+
+
+# ORs finer bitmaps into coarser ones and removes them from pending set.
+# KEYS[1] is versions hash, KEYS[2] is pending set, then each source bitmap
+# followed by ARGV[1] destination bitmaps.
+rollup_or = LazzyScript("""
+    local n = tonumber(ARGV[1])
+    local count = 0
+    for i = 3, #KEYS, n + 1 do
+        local source = KEYS[i]
+        if redis.call('exists', source) == 1 then
+            for j = i + 1, i + n do
+                redis.call('bitop', 'OR', KEYS[j], KEYS[j], source)
+                redis.call('hincrby', KEYS[1], KEYS[j], 1)
+            end
+        end
+        redis.call('zrem', KEYS[2], source)
+        count = count + 1
+    end
+    return count
+""")
+
+
+# Adds `(score, member)` pairs from ARGV[3] to KEYS[1] sorted set and trims
+# it to ARGV[1] newest members (0 - no limit) and members with score not
+# less than ARGV[2] (empty - no limit). Returns number of removed members.
+# Pairs are added by slices, `unpack` of all ARGV may overflow Lua stack.
+capped_zadd = LazzyScript("""
+    local max_length, min_score = tonumber(ARGV[1]), ARGV[2]
+    for i = 3, #ARGV, 1000 do
+        redis.call('zadd', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+    end
+    local removed = 0
+    if min_score ~= '' then
+        removed = redis.call('zremrangebyscore', KEYS[1], '-inf',
+                             '(' .. min_score)
+    end
+    if max_length > 0 then
+        removed = removed + redis.call('zremrangebyrank', KEYS[1], 0,
+                                       -max_length - 1)
+    end
+    return removed
+""")
+
+
 first_key_with_bit_set = LazzyScript("""
     for index, value in ipairs(KEYS) do
         local bit = redis.call('getbit', value, ARGV[1])
@@ -80,6 +365,153 @@ multiset_intersection_update = LazzyScript("""
 """)
 
 
+# Sets ARGV[1] field of KEYS[1] hash to ARGV[2] unless it exists, returns
+# the current value.
+hsetdefault = LazzyScript("""
+    if redis.call('hsetnx', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+        return ARGV[2]
+    end
+    return redis.call('hget', KEYS[1], ARGV[1])
+""")
+
+
+# Removes ARGV[1] field of KEYS[1] hash, returns its value.
+hpop = LazzyScript("""
+    local value = redis.call('hget', KEYS[1], ARGV[1])
+    if value then
+        redis.call('hdel', KEYS[1], ARGV[1])
+    end
+    return value
+""")
+
+
+# Ranked counters: KEYS[1] is a sorted set of counts, KEYS[2] is a total of
+# all counts which is adjusted by every script.
+
+# Sets ARGV[2] member count to ARGV[3] (if it's missing only when ARGV[1] is
+# `nx`), returns the current count.
+ranked_counter_set = LazzyScript("""
+    local current = redis.call('zscore', KEYS[1], ARGV[2])
+    if current and ARGV[1] == 'nx' then
+        return current
+    end
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[2])
+    redis.call('incrby', KEYS[2], ARGV[3] - (current or 0))
+    return ARGV[3]
+""")
+
+
+# Removes ARGV[1] member, returns its count.
+ranked_counter_pop = LazzyScript("""
+    local current = redis.call('zscore', KEYS[1], ARGV[1])
+    if current then
+        redis.call('zrem', KEYS[1], ARGV[1])
+        redis.call('decrby', KEYS[2], current)
+    end
+    return current
+""")
+
+
+# ARGV[1] is `union` or `intersection`, the rest are `(member, count)` pairs.
+ranked_counter_multiset_update = LazzyScript("""
+    local values = {}
+    for i = 2, #ARGV, 2 do
+        values[ARGV[i]] = tonumber(ARGV[i + 1])
+    end
+    if ARGV[1] == 'union' then
+        local delta = 0
+        for member, new in pairs(values) do
+            local current = tonumber(redis.call('zscore', KEYS[1], member))
+            if new > 0 and (not current or new > current) then
+                redis.call('zadd', KEYS[1], new, member)
+                delta = delta + new - (current or 0)
+            end
+        end
+        redis.call('incrby', KEYS[2], delta)
+    else
+        local members = redis.call('zrange', KEYS[1], 0, -1, 'withscores')
+        local total = 0
+        redis.call('del', KEYS[1])
+        for i = 1, #members, 2 do
+            local new = values[members[i]]
+            if new and new > 0 then
+                new = math.min(new, tonumber(members[i + 1]))
+                redis.call('zadd', KEYS[1], new, members[i])
+                total = total + new
+            end
+        end
+        redis.call('set', KEYS[2], total)
+    end
+""")
+
+
+# Sums counters KEYS (except the last one, which is a destination key) and
+# returns top ARGV[2] items (all if 0) with counts. ARGV[1] is counters type
+# (`hash` or `zset`). Sum is kept in destination key for ARGV[3] seconds and
+# is reused while it exists, 0 - sum is not kept.
+counters_range_top = LazzyScript("""
+    local dest = KEYS[#KEYS]
+    local n, ttl = tonumber(ARGV[2]), tonumber(ARGV[3])
+    if ttl > 0 and redis.call('exists', dest) == 1 then
+        return redis.call('zrevrange', dest, 0, n - 1, 'withscores')
+    end
+    redis.call('del', dest)
+    if ARGV[1] == 'zset' then
+        -- Summed by slices, `unpack` of all keys may overflow Lua stack.
+        local sources = #KEYS - 1
+        redis.call('zunionstore', dest, math.min(1000, sources),
+                   unpack(KEYS, 1, math.min(1000, sources)))
+        for i = 1001, sources, 999 do
+            local last = math.min(i + 998, sources)
+            redis.call('zunionstore', dest, last - i + 2, dest,
+                       unpack(KEYS, i, last))
+        end
+    else
+        -- Summed in a table, a command per field is much slower.
+        local sums, fields = {}, {}
+        for i = 1, #KEYS - 1 do
+            local data = redis.call('hgetall', KEYS[i])
+            for j = 1, #data, 2 do
+                local field = data[j]
+                if not sums[field] then
+                    fields[#fields + 1] = field
+                    sums[field] = 0
+                end
+                sums[field] = sums[field] + tonumber(data[j + 1])
+            end
+        end
+        if ttl == 0 and n > 0 then
+            -- Ties are ordered like ZREVRANGE does.
+            table.sort(fields, function(a, b)
+                return sums[a] > sums[b] or (sums[a] == sums[b] and a > b)
+            end)
+            local result = {}
+            for i = 1, math.min(n, #fields) do
+                result[#result + 1] = fields[i]
+                result[#result + 1] = tostring(sums[fields[i]])
+            end
+            return result
+        end
+        local args = {}
+        for i, field in ipairs(fields) do
+            args[#args + 1] = sums[field]
+            args[#args + 1] = field
+            if #args >= 1000 or i == #fields then
+                redis.call('zadd', dest, unpack(args))
+                args = {}
+            end
+        end
+    end
+    local result = redis.call('zrevrange', dest, 0, n - 1, 'withscores')
+    if ttl > 0 then
+        redis.call('expire', dest, ttl)
+    else
+        redis.call('del', dest)
+    end
+    return result
+""")
+
+
 multiset_union_update = LazzyScript("""
     for i = 1, #ARGV, 2 do
         local current = tonumber(redis.call('HGET', KEYS[1], ARGV[i]))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zlib
+
+from .compat import lz4_frame, zstandard
+
+__all__ = ['RAW_HEADER', 'Codec', 'register_codec', 'get_codec',
+           'CompressedSerializer']
+
+
+# Header of values stored without compression.
+RAW_HEADER = b'\x00'
+
+_codecs = {}
+
+
+class Codec(object):
+    """
+    Compression codec identified by a single `header` byte, which is stored
+    as the first byte of every compressed value.
+    """
+
+    def __init__(self, name, header, compress, decompress):
+        assert len(header) == 1 and header != RAW_HEADER, \
+            '`header` should be a single byte other than RAW_HEADER.'
+        self.name = name
+        self.header = header
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return '<Codec: {0}>'.format(self.name)
+
+
+def register_codec(name, header, compress, decompress):
+    """
+    Registers codec available to `CompressedSerializer`. `compress` is
+    called with `(data, level)` arguments, where level may be `None`.
+    """
+    codec = Codec(name, header, compress, decompress)
+    _codecs[name] = _codecs[header] = codec
+    return codec
+
+
+def get_codec(name_or_header):
+    try:
+        return _codecs[name_or_header]
+    except KeyError:
+        raise LookupError("Codec `{0}` not registered.".format(name_or_header))
+
+
+register_codec('zlib', b'\x01',
+               lambda data, level: zlib.compress(
+                   data, 6 if level is None else level),
+               zlib.decompress)
+
+if lz4_frame:
+    register_codec('lz4', b'\x02',
+                   lambda data, level: lz4_frame.compress(
+                       data, compression_level=level or 0),
+                   lz4_frame.decompress)
+
+if zstandard:
+    register_codec('zstd', b'\x03',
+                   lambda data, level: zstandard.ZstdCompressor(
+                       level=3 if level is None else level).compress(data),
+                   lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+class CompressedSerializer(object):
+    """
+    Wraps `serializer` and compresses dumped values of at least `threshold`
+    bytes with `codec`, when it makes them smaller. Values are prefixed by
+    a header byte, so values compressed by any registered codec can be
+    loaded. Values without known header (e.g. stored before compression was
+    enabled) are loaded as is, which is safe for text serializers like json.
+
+    Examples::
+
+        serializer = CompressedSerializer('json', codec='zlib', threshold=512)
+        Timeline('events', serializer=serializer)
+        Timeline('events', serializer='json_zlib')
+    """
+
+    def __init__(self, serializer='json', codec='zlib', threshold=512,
+                 level=None):
+        if not hasattr(serializer, 'loads'):
+            from .conf import get_serializer
+            serializer = get_serializer(serializer)
+        self.serializer = serializer
+        self.codec = get_codec(codec)
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if len(data) >= self.threshold:
+            compressed = self.codec.compress(data, self.level)
+            if len(compressed) < len(data):
+                return self.codec.header + compressed
+        return RAW_HEADER + data
+
+    def loads(self, value):
+        header = value[:1]
+        if header == RAW_HEADER:
+            value = value[1:]
+        elif header in _codecs:
+            value = _codecs[header].decompress(value[1:])
+        return self.serializer.loads(value)
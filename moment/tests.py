@@ -2,17 +2,808 @@
 # -*- coding: utf-8 -*-
 
 import time
+import calendar
 import uuid
 import unittest
+from datetime import datetime
 
 from . import conf
+from . import bloom
+from . import cache
+from . import bitevents
+from . import buffers
+from . import counters
+from . import collections
 from . import timelines
+from . import serializers
 from . import keys
 
 
 client = conf.register_connection()
 
 
+##############################################################################
+# Cache Tests
+##############################################################################
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_size_eviction(self):
+        lru = cache.LRUCache(2)
+        lru['a'], lru['b'] = 1, 2
+        self.assertEqual(lru['a'], 1)
+        lru['c'] = 3
+        self.assertTrue('a' in lru and 'c' in lru)
+        self.assertFalse('b' in lru)
+        self.assertRaises(KeyError, lambda: lru['b'])
+        stats = lru.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual((stats['evictions'], stats['size']), (1, 2))
+
+    def test_ttl_eviction(self):
+        lru = cache.LRUCache(10, ttl=0.01)
+        lru['a'] = 1
+        self.assertEqual(lru.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.stats()['expirations'], 1)
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_membership(self):
+        bf = bloom.BloomFilter(1000, error_rate=0.01)
+        bf.update('item{0}'.format(i) for i in range(1000))
+        count = len(bf)
+        bf.add('item0')
+        self.assertEqual(len(bf), count)
+        self.assertTrue(990 <= count <= 1000)
+        self.assertFalse(bf.is_saturated)
+        for i in range(1000):
+            self.assertTrue('item{0}'.format(i) in bf)
+        false_positives = sum(1 for i in range(10000)
+                              if 'other{0}'.format(i) in bf)
+        self.assertTrue(false_positives < 300)
+
+    def test_bytes_and_ints(self):
+        bf = bloom.BloomFilter(10)
+        bf.add(b'foo')
+        bf.add(5)
+        self.assertTrue('foo' in bf)
+        self.assertTrue(b'5' in bf)
+
+
+##############################################################################
+# Serializer Tests
+##############################################################################
+
+class CompressedSerializerTestCase(unittest.TestCase):
+
+    def test_dumps_loads(self):
+        s = serializers.CompressedSerializer('json', threshold=100)
+        small, big = {'a': 1}, {'a': 'x' * 1000}
+        self.assertEqual(s.dumps(small)[:1], serializers.RAW_HEADER)
+        self.assertEqual(s.dumps(big)[:1], b'\x01')
+        self.assertTrue(len(s.dumps(big)) < 100)
+        for value in [small, big]:
+            self.assertEqual(s.loads(s.dumps(value)), value)
+        # Values stored before compression was enabled
+        self.assertEqual(s.loads(b'{"a": 1}'), small)
+        self.assertRaises(LookupError, serializers.CompressedSerializer,
+                          'json', codec='unknown')
+
+    def test_timeline(self):
+        timeline = timelines.Timeline('test', serializer='json_zlib')
+        try:
+            timeline.add({'a': 'x' * 1000}, timestamp=1)
+            self.assertEqual(timeline.items()[0], ({'a': 'x' * 1000}, 1))
+        finally:
+            timeline.delete()
+
+
+##############################################################################
+# Sequence Tests
+##############################################################################
+
+class SequenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequence = bitevents.Sequence('test_sequence')
+
+    def tearDown(self):
+        self.sequence.delete()
+
+    def test_sequential_id(self):
+        self.assertEqual(self.sequence.sequential_id('foo'), 0)
+        self.assertEqual(self.sequence.sequential_id('bar'), 1)
+        self.assertEqual(self.sequence.sequential_id('foo'), 0)
+        self.assertTrue('foo' in self.sequence)
+        self.assertFalse('baz' in self.sequence)
+
+    def test_sequential_ids(self):
+        self.assertEqual(self.sequence.sequential_id('foo'), 0)
+        ids = self.sequence.sequential_ids(['bar', 'foo', 'baz', 'bar'])
+        self.assertEqual(ids, [1, 0, 2, 1])
+        self.assertEqual(len(self.sequence), 3)
+
+    def test_sequential_ids_lookup(self):
+        self.sequence.sequential_ids(['foo', 'bar'])
+        ids = self.sequence.sequential_ids(['bar', 'baz'], create=False)
+        self.assertEqual(ids, [1, None])
+        self.assertEqual(len(self.sequence), 2)
+
+    def test_cache(self):
+        sequence = bitevents.Sequence('test_sequence', cache_size=1)
+        sequence.sequential_ids(['foo', 'bar'])
+        self.assertEqual(sequence.sequential_id('bar'), 1)
+        self.assertEqual(sequence.sequential_id('foo'), 0)
+        stats = sequence.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertEqual(stats['evictions'], 2)
+
+        sequence = bitevents.Sequence('test_sequence', cache_size=0)
+        self.assertEqual(sequence.cache, None)
+        self.assertEqual(sequence.sequential_id('bar'), 1)
+
+    def test_bloom(self):
+        self.sequence.sequential_ids(['foo', 'bar'])
+        sequence = bitevents.Sequence('test_sequence', cache_size=0)
+        sequence.build_bloom()
+        self.assertTrue('foo' in sequence)
+        self.assertFalse('baz' in sequence)
+        self.assertEqual(sequence.sequential_ids(['bar', 'baz'], create=False),
+                         [1, None])
+        sequence.sequential_id('baz')
+        self.assertTrue('baz' in sequence.bloom)
+        self.assertTrue('baz' in sequence)
+
+    def test_bloom_refresh(self):
+        self.sequence.sequential_id('foo')
+        sequence = self.sequence.clone(cache_size=0)
+        bloom = sequence.build_bloom()
+        sequence.bloom_refresh_interval = 0.01
+        event = bitevents.DayEvent('test_event', sequence=sequence)
+        # Recorded by another process
+        bitevents.record_events('bar', 'test_event', 'day',
+                                sequence=self.sequence)
+        try:
+            time.sleep(0.02)
+            self.assertTrue(event.is_recorded('bar'))
+            self.assertTrue('bar' in sequence)
+            self.assertTrue(sequence.bloom is bloom and 'bar' in bloom)
+        finally:
+            event.delete()
+
+
+class HashSequenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequence = bitevents.HashSequence('test_sequence', reverse=True)
+
+    def tearDown(self):
+        self.sequence.delete()
+
+    def test_sequential_ids(self):
+        self.assertEqual(self.sequence.sequential_id('foo'), 0)
+        ids = self.sequence.sequential_ids(['bar', 'foo', 'baz', 'bar'])
+        self.assertEqual(ids, [1, 0, 2, 1])
+        self.assertEqual(len(self.sequence), 3)
+        self.assertTrue('foo' in self.sequence)
+        self.assertFalse('qux' in self.sequence)
+        ids = self.sequence.sequential_ids(['baz', 'qux'], create=False)
+        self.assertEqual(ids, [2, None])
+
+    def test_uuids(self):
+        self.sequence.sequential_ids(['foo', 'bar'])
+        self.assertEqual(self.sequence.uuids([1, 0, 5]), [b'bar', b'foo', None])
+        self.assertEqual(self.sequence.uuids([]), [])
+        sequence = bitevents.HashSequence('test_sequence')
+        self.assertRaises(LookupError, sequence.uuids, [0])
+
+    def test_bloom_refresh(self):
+        self.sequence.sequential_ids(['foo', 'bar'])
+        sequence = self.sequence.clone(cache_size=0)
+        bloom = sequence.build_bloom()
+        sequence.bloom_refresh_interval = 0.01
+        self.sequence.sequential_id('baz')
+        time.sleep(0.02)
+        self.assertTrue('baz' in sequence)
+        self.assertTrue(sequence.bloom is bloom and 'baz' in bloom)
+
+    def test_migrate_from(self):
+        source = bitevents.Sequence('test_sequence')
+        try:
+            source.sequential_ids(['foo', 'bar', 'baz'])
+            self.assertEqual(self.sequence.migrate_from(source, 2), 3)
+            self.assertEqual(self.sequence.uuids([0, 2]), [b'foo', b'baz'])
+            ids = self.sequence.sequential_ids(['baz', 'qux'])
+            self.assertEqual(ids, [2, 3])
+        finally:
+            source.delete()
+
+    def test_record_events(self):
+        event, = bitevents.record_events(['foo', 'bar'], 'test_event', 'day',
+                                         sequence=self.sequence)
+        try:
+            self.assertEqual(event.count(), 2)
+            self.assertTrue('bar' in event)
+            self.assertFalse('baz' in event)
+        finally:
+            event.delete()
+
+
+##############################################################################
+# Events Tests
+##############################################################################
+
+class RecordEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequence = bitevents.Sequence('test_users')
+        self.uuids = ['user{0}'.format(i) for i in range(25)]
+
+    def tearDown(self):
+        self.sequence.delete()
+        bitevents.DayEvent('test_event').delete()
+        bitevents.MonthEvent('test_event').delete()
+
+    def test_record_with_sequence(self):
+        events = bitevents.record_events(self.uuids, 'test_event',
+                                         ['day', 'month'],
+                                         sequence=self.sequence, chunk_size=10)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(len(self.sequence), len(self.uuids))
+        for event in events:
+            self.assertEqual(event.count(), len(self.uuids))
+            self.assertTrue('user0' in event)
+            self.assertFalse('unknown' in event)
+        self.assertEqual(self.sequence.sequential_id('user0'), 0)
+        self.assertEqual(self.sequence.sequential_id('user24'), 24)
+
+    def test_record_twice(self):
+        bitevents.record_events(self.uuids, 'test_event', 'day',
+                                sequence=self.sequence)
+        bitevents.record_events(self.uuids + ['user25', 'user25'],
+                                'test_event', 'day', sequence=self.sequence)
+        self.assertEqual(len(self.sequence), len(self.uuids) + 1)
+        self.assertEqual(bitevents.DayEvent('test_event').count(),
+                         len(self.uuids) + 1)
+
+    def test_record_without_sequence(self):
+        event, = bitevents.record_events([1, 5, '7'], 'test_event', 'day')
+        self.assertEqual(event.count(), 3)
+        self.assertTrue(5 in event)
+        self.assertFalse(2 in event)
+
+    def test_members(self):
+        uuids = self.uuids[::3]
+        event, = bitevents.record_events(uuids, 'test_event', 'day',
+                                         sequence=self.sequence)
+        self.assertEqual(list(event.iter_ids(chunk_size=1)),
+                         list(range(0, len(uuids))))
+        members = [m.decode() for m in event.members(chunk_size=1, batch_size=3)]
+        self.assertEqual(members, uuids)
+
+    def test_sparse_members(self):
+        ids = [0, 9, 10, 1000, 70000]
+        event, = bitevents.record_events(ids, 'test_event', 'day')
+        self.assertEqual(list(event.members(chunk_size=7)), ids)
+        self.sequence.sequential_ids(self.uuids)
+        self.assertEqual(self.sequence.uuids([24, 0, 100]), [b'user24', b'user0', None])
+
+    def test_rollup(self):
+        dt1, dt2 = datetime(2015, 3, 1, 10, 30), datetime(2015, 3, 1, 11, 30)
+        hour, day, month = bitevents.record_events(
+            self.uuids[:10], 'test_event', ['hour', 'day', 'month'], dt1,
+            sequence=self.sequence, rollup=True)
+        bitevents.record_events(self.uuids[5:20], 'test_event',
+                                ['hour', 'day', 'month'], dt2,
+                                sequence=self.sequence, rollup=True)
+        hour2 = bitevents.HourEvent.from_date('test_event', dt2,
+                                              sequence=self.sequence)
+        try:
+            self.assertFalse(client.exists(day.key) or client.exists(month.key))
+            self.assertEqual(hour.count(), 10)
+            self.assertEqual(day.count(), 20)
+            self.assertEqual(month.count(), 20)
+            self.assertTrue('user15' in day and 'user25' not in day)
+            self.assertEqual(len(day & hour2), 15)
+            self.assertEqual(len(bitevents.Event.range(
+                'test_event', dt1, dt2, sequence=self.sequence)), 0)
+            self.assertEqual(len(bitevents.Event.range(
+                'test_event', dt1, dt2, sequence=self.sequence, rollup=True)), 20)
+            matrix = bitevents.retention_matrix(
+                'test_event', 'test_event', 'day', dt1, 2,
+                sequence=self.sequence, rollup=True)
+            self.assertEqual(matrix, [[20, 0], [0]])
+            # Default rollup flag
+            self.assertEqual(bitevents.DayEvent.from_date(
+                'test_event', dt1, sequence=self.sequence).count(), 0)
+            conf.MOMENT_EVENT_ROLLUP = True
+            try:
+                day2 = bitevents.DayEvent.from_date('test_event', dt1,
+                                                    sequence=self.sequence)
+                self.assertEqual(day2.count(), 20)
+                self.assertEqual(len(day2 & hour2), 15)
+                self.assertEqual(len(bitevents.Event.range(
+                    'test_event', dt1, dt2, sequence=self.sequence)), 20)
+                matrix = bitevents.retention_matrix(
+                    'test_event', 'test_event', 'day', dt1, 2,
+                    sequence=self.sequence)
+                self.assertEqual(matrix, [[20, 0], [0]])
+            finally:
+                conf.MOMENT_EVENT_ROLLUP = False
+
+            n = bitevents.rollup_events('test_event', ['day', 'month'],
+                                        until=datetime(2015, 3, 1, 11),
+                                        batch_size=1)
+            self.assertEqual(n, 2)
+            self.assertEqual(day.pending_keys(), [hour2.key])
+            self.assertEqual(client.bitcount(day.key), 10)
+            self.assertEqual(day.count(), 20)
+            # Types are rolled up independently
+            n = bitevents.rollup_events('test_event', 'day')
+            self.assertEqual(n, 1)
+            self.assertEqual(month.pending_keys(), [hour2.key])
+            self.assertEqual(month.count(), 20)
+            n = bitevents.rollup_events('test_event', ['day', 'month'])
+            self.assertEqual(n, 1)
+            self.assertEqual(day.pending_keys(), [])
+            self.assertEqual(client.bitcount(month.key), 20)
+            self.assertEqual(sorted(day.iter_ids()), list(range(20)))
+        finally:
+            for ev in [hour, hour2, day, month]:
+                ev.delete()
+            client.delete(
+                bitevents._rollup_key('test_event', bitevents.DayEvent),
+                bitevents._rollup_key('test_event', bitevents.MonthEvent))
+            bitevents.delete_temporary_bitop_keys()
+
+
+class BitOperationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.a = bitevents.DayEvent('test_a', 2015, 3, 1)
+        self.b = bitevents.DayEvent('test_b', 2015, 3, 1)
+        self.c = bitevents.DayEvent('test_c', 2015, 3, 1)
+        self.d = bitevents.DayEvent('test_d', 2015, 3, 1)
+        self.a_ids, self.b_ids = set(range(0, 20)), set(range(10, 30))
+        self.c_ids, self.d_ids = set(range(0, 5)), set([15, 100])
+        for ev, ids in [(self.a, self.a_ids), (self.b, self.b_ids),
+                        (self.c, self.c_ids), (self.d, self.d_ids)]:
+            ev.sequential_ids(ids, [ev.key])
+
+    def tearDown(self):
+        for ev in [self.a, self.b, self.c, self.d]:
+            ev.delete()
+        bitevents.delete_temporary_bitop_keys()
+        client.delete(bitevents._versions_key(), bitevents._fingerprints_key())
+
+    def bitop_keys(self):
+        return sorted(bitevents.delete_temporary_bitop_keys(dryrun=True))
+
+    def test_operations(self):
+        self.assertEqual(len(self.a & self.b), len(self.a_ids & self.b_ids))
+        self.assertEqual(len(self.a | self.b), len(self.a_ids | self.b_ids))
+        self.assertEqual(len(self.a ^ self.b), len(self.a_ids ^ self.b_ids))
+        self.assertEqual(len(self.a - self.b), len(self.a_ids - self.b_ids))
+        self.assertEqual(len(bitevents.LDiff(self.b, self.a, self.c)),
+                         len(self.b_ids))
+        self.assertEqual(len(~self.a), 24 - len(self.a_ids))
+
+    def test_nested_count(self):
+        expr = (self.a & self.b) - (self.c | self.d)
+        expected = (self.a_ids & self.b_ids) - (self.c_ids | self.d_ids)
+        self.assertEqual(expr.count(), len(expected))
+        self.assertFalse(expr.is_evaluated)
+        self.assertEqual(self.bitop_keys(), [])
+
+    def test_nested_evaluate(self):
+        expr = (self.a | self.d) - self.b
+        expected = (self.a_ids | self.d_ids) - self.b_ids
+        self.assertEqual(sorted(expr.members()), sorted(expected))
+        self.assertTrue(expr.is_evaluated)
+        self.assertTrue(15 not in expr and 100 in expr)
+        self.assertEqual(self.bitop_keys(), [expr.key.encode()])
+
+    def test_evaluated_operand(self):
+        inner = (self.a & self.b).evaluate()
+        expr = inner | self.c
+        self.assertEqual(len(expr), len((self.a_ids & self.b_ids) | self.c_ids))
+
+    def test_result_cache(self):
+        stats = bitevents.BitOperation.cache_stats
+        stats.reset()
+        expr = self.a & self.b
+        expr.use_cache = True
+        self.assertEqual(expr.count(), 10)
+        self.assertEqual((stats.hits, stats.misses), (0, 1))
+        self.assertEqual(self.bitop_keys(), [expr.key.encode()])
+
+        expr = self.a & self.b
+        expr.use_cache = True
+        self.assertEqual(expr.count(), 10)
+        self.assertTrue(19 in expr)
+        self.assertEqual((stats.hits, stats.misses), (2, 1))
+
+        self.b.record(5)
+        self.assertEqual(expr.count(), 11)
+        self.assertEqual((stats.hits, stats.misses), (2, 2))
+
+        empty = self.c & self.d
+        empty.use_cache = True
+        self.assertEqual((empty.count(), empty.count()), (0, 0))
+        self.assertEqual((stats.hits, stats.misses), (3, 3))
+        self.assertEqual(stats.hit_rate, 0.5)
+
+    def test_nested_result_cache(self):
+        inner = self.a | self.c
+        inner.use_cache = True
+        self.assertEqual(inner.count(), 20)
+        expr = inner & self.d
+        expr.use_cache = True
+        self.assertEqual(expr.count(), 1)
+        self.a.record(100)
+        self.assertEqual(expr.count(), 2)
+        self.assertEqual((inner & self.d).count(), 2)
+        self.assertEqual(inner.count(), 21)
+
+    def test_ttl(self):
+        expr = (self.a & self.b).evaluate()
+        ttl = client.ttl(expr.key)
+        self.assertTrue(0 < ttl <= conf.MOMENT_BITOP_TTL)
+        expr = self.a | self.b
+        expr.ttl = 0
+        expr.evaluate()
+        self.assertEqual(client.ttl(expr.key), -1)
+
+    def test_expired_result(self):
+        inner = (self.a & self.b).evaluate()
+        expr = (inner | self.d).evaluate()
+        for op in [inner, expr]:
+            client.pexpire(op.key, 1)
+        time.sleep(0.01)
+        self.assertEqual(inner.count(), 10)
+        self.assertEqual(sorted(expr.iter_ids()), list(range(10, 20)) + [100])
+        self.assertEqual(len(inner | self.c), 15)
+        self.assertTrue(15 in inner)
+
+    def test_scope(self):
+        outer = (self.a | self.b).evaluate()
+        with bitevents.BitOpScope():
+            expr = (self.a & self.b).evaluate()
+            with bitevents.BitOpScope():
+                nested = (self.a ^ self.b).evaluate()
+            self.assertEqual(self.bitop_keys(),
+                             sorted([outer.key.encode(), expr.key.encode()]))
+            self.assertFalse(nested.is_evaluated)
+        self.assertEqual(self.bitop_keys(), [outer.key.encode()])
+
+    def test_retention_matrix(self):
+        cohorts = [set(range(10)), set(range(10, 15)), set(range(20, 30))]
+        activity = [set(range(0, 20, 2)), set(range(5, 15)), set(range(25))]
+        events = []
+        for i in range(3):
+            dt = datetime(2015, 3, 1 + 7 * i)
+            cohort = bitevents.WeekEvent.from_date('test_cohort', dt)
+            active = bitevents.WeekEvent.from_date('test_active', dt)
+            cohort.sequential_ids(cohorts[i], [cohort.key])
+            active.sequential_ids(activity[i], [active.key])
+            events.extend([cohort, active])
+        try:
+            matrix = bitevents.retention_matrix(
+                'test_cohort', 'test_active', 'week', datetime(2015, 3, 1), 3)
+            expected = [[len(cohorts[i] & activity[i + j]) for j in range(3 - i)]
+                        for i in range(3)]
+            self.assertEqual(matrix, expected)
+            self.assertEqual(self.bitop_keys(), [])
+        finally:
+            for ev in events:
+                ev.delete()
+
+    def test_funnel(self):
+        steps = bitevents.funnel([self.a, self.b, self.a | self.c, self.d])
+        self.assertEqual(steps, [(20, 0), (10, 10), (10, 0), (1, 9)])
+        steps = bitevents.funnel([self.c, self.b, self.a])
+        self.assertEqual(steps, [(5, 0), (0, 5), (0, 0)])
+        self.assertEqual(self.bitop_keys(), [])
+
+    def test_range(self):
+        start, end = datetime(2015, 2, 27, 22), datetime(2015, 3, 2, 1)
+        for event_type in [bitevents.HourEvent, bitevents.DayEvent,
+                           bitevents.WeekEvent, bitevents.MonthEvent]:
+            keys, ev = [], event_type.from_date('test_a', start)
+            while ev.period_start() <= end:
+                keys.append(ev.key)
+                ev = ev.next()
+            self.assertEqual(list(event_type.period_keys('test_a', start, end)),
+                             keys)
+
+        expr = bitevents.Event.range('test_a', datetime(2015, 2, 28),
+                                     datetime(2015, 3, 2))
+        self.assertEqual(expr.event_keys, [
+            bitevents.DayEvent('test_a', 2015, 2, 28).key,
+            self.a.key,
+            bitevents.DayEvent('test_a', 2015, 3, 2).key])
+        self.assertEqual(expr.count(), len(self.a_ids))
+        self.assertEqual(self.bitop_keys(), [])
+        expr = bitevents.WeekEvent.range('test_a', start, end)
+        self.assertEqual(len(expr.events), 2)
+        expr = bitevents.YearEvent.range('test_a', start, end)
+        self.assertEqual(expr.event_keys, ['spm:evt:test_a:2015'])
+
+    def test_many_operands(self):
+        hour = bitevents.HourEvent('test_a', 2015, 6, 1, 0)
+        hour.sequential_ids([1, 2], [hour.key])
+        try:
+            expr = bitevents.HourEvent.range('test_a', datetime(2015, 1, 1),
+                                             datetime(2015, 12, 31, 23))
+            self.assertEqual(len(expr.events), 8760)
+            self.assertEqual(expr.count(), 2)
+            expr.use_cache = True
+            self.assertEqual(expr.count(), 2)
+            self.assertEqual(len(bitevents.And(self.a, *expr.events)), 0)
+            # a - (hour & hour & ...) == a - hour
+            self.assertEqual(len(bitevents.LDiff(self.a, *([hour] * 9000))),
+                             len(self.a_ids - set([1, 2])))
+        finally:
+            hour.delete()
+
+    def test_year_event(self):
+        stats = bitevents.BitOperation.cache_stats
+        stats.reset()
+        year = bitevents.YearEvent('test_a', 2015)
+        self.assertEqual(year.key, 'spm:evt:test_a:2015')
+        march = bitevents.MonthEvent('test_a', 2015, 3)
+        march.sequential_ids(self.a_ids, [march.key])
+        month = bitevents.MonthEvent('test_a', 2015, 5)
+        month.sequential_ids([100, 200], [month.key])
+        try:
+            self.assertEqual(year.count(), len(self.a_ids) + 2)
+            self.assertEqual(len(year), len(self.a_ids) + 2)
+            self.assertTrue(200 in year and 30 not in year)
+            self.assertEqual((stats.misses, stats.hits), (1, 3))
+            month.record(300)
+            self.assertEqual(sorted(year.members()),
+                             sorted(self.a_ids | set([100, 200, 300])))
+            self.assertEqual(stats.misses, 2)
+            self.assertEqual(len(year & self.b), len(self.a_ids & self.b_ids))
+            self.assertEqual(self.bitop_keys(), [])
+            self.assertRaises(NotImplementedError, year.record, 1)
+        finally:
+            year.delete(cascade=True)
+
+    def test_record_materialized(self):
+        dt = datetime(2015, 3, 1)
+        day, year = bitevents.record_events(
+            [1, 2], 'test_year', [bitevents.DayEvent, bitevents.YearEvent], dt)
+        try:
+            self.assertEqual(year.count(), 2)
+            self.assertEqual(
+                bitevents.MonthEvent.from_date('test_year', dt).count(), 2)
+            self.assertEqual(day.count(), 2)
+        finally:
+            day.delete()
+            year.delete(cascade=True)
+
+    def test_materialized_rollup(self):
+        dt = datetime(2015, 3, 1)
+        day, year = bitevents.record_events(
+            [1, 2], 'test_year', ['day', bitevents.YearEvent], dt, rollup=True)
+        try:
+            self.assertFalse(client.exists(year.key))
+            self.assertEqual(year.count(), 2)
+            self.assertTrue(2 in year)
+            matrix = bitevents.retention_matrix(
+                'test_year', 'test_year', bitevents.YearEvent, dt, 1,
+                rollup=True)
+            self.assertEqual(matrix, [[2]])
+        finally:
+            day.delete()
+            year.delete(cascade=True)
+            client.delete(bitevents._rollup_key('test_year',
+                                                bitevents.MonthEvent))
+
+    def test_delete_temporary_bitop_keys(self):
+        ops = [(self.a & self.b), (self.a | self.b), (self.a ^ self.c)]
+        for op in ops:
+            op.evaluate()
+        keys = bitevents.delete_temporary_bitop_keys(batch_size=2, rate_limit=1000)
+        self.assertEqual(sorted(keys), sorted(op.key.encode() for op in ops))
+        self.assertEqual(self.bitop_keys(), [])
+
+    def test_delete_expired_bitop_fields(self):
+        plain = (self.a & self.b).evaluate()
+        self.assertFalse(client.hexists(bitevents._versions_key(), plain.key))
+        cached = self.a | self.b
+        cached.use_cache = True
+        cached.evaluate()
+        client.pexpire(cached.key, 1)
+        time.sleep(0.01)
+        self.assertEqual(bitevents.delete_temporary_bitop_keys(), [plain.key.encode()])
+        for hash_key in [bitevents._versions_key(), bitevents._fingerprints_key()]:
+            self.assertFalse(client.hexists(hash_key, cached.key))
+        self.assertEqual(cached.count(), 30)
+
+    def test_delete_orphan_versions(self):
+        cached = self.a | self.b
+        cached.use_cache = True
+        self.assertEqual(cached.count(), 30)
+        self.a.delete()
+        pattern = bitevents._key('evt:bitop_*')
+        self.assertEqual(bitevents._delete_orphan_bitop_fields(client, pattern), 2)
+        self.assertFalse(client.hexists(bitevents._versions_key(), self.a.key))
+        self.assertTrue(client.hexists(bitevents._versions_key(), self.b.key))
+        # Recreated bitmap has the same version as before deletion.
+        self.a.sequential_ids([1], [self.a.key])
+        self.assertEqual(cached.count(), len(self.b_ids | set([1])))
+
+
+##############################################################################
+# Dict Tests
+##############################################################################
+
+class Dict(collections.BaseDict):
+    key_format = 'test_dict'
+
+
+class DictTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dict = Dict('test_dict')
+
+    def tearDown(self):
+        self.dict.delete()
+
+    def test_update_and_get_many(self):
+        self.dict.update({'a': [1]}, [('b', {'x': 2})], c='3')
+        self.assertEqual(self.dict.get_many(['c', 'd', 'a'], 0),
+                         ['3', 0, [1]])
+        self.assertEqual(self.dict.get_many([]), [])
+        self.assertEqual(len(self.dict), 3)
+
+    def test_setdefault_and_pop(self):
+        self.assertEqual(self.dict.setdefault('a', [1]), [1])
+        self.assertEqual(self.dict.setdefault('a', [2]), [1])
+        self.assertEqual(self.dict.pop('a'), [1])
+        self.assertEqual(self.dict.pop('a', None), None)
+        self.assertRaises(KeyError, self.dict.pop, 'a')
+
+
+##############################################################################
+# Counter Tests
+##############################################################################
+
+class CounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dt = datetime(2015, 3, 1, 10)
+        self.day = counters.DayCounter.from_date('test_counter', self.dt)
+        self.month = counters.MonthCounter.from_date('test_counter', self.dt)
+
+    def tearDown(self):
+        self.day.delete()
+        self.month.delete()
+
+    def test_update(self):
+        self.day.update({'a': 2, 'b': 1}, b=2)
+        self.day.update(['a', 'c'])
+        self.day.subtract(c=1)
+        self.assertEqual(dict(self.day.items()), {b'a': 3, b'b': 3, b'c': 0})
+
+    def test_lazy_iteration(self):
+        values = dict(('k{0}'.format(i), i) for i in range(300))
+        ranked = counters.RankedDayCounter.from_date('test_counter', self.dt)
+        try:
+            for counter in [self.day, ranked]:
+                counter.update(values)
+                items = dict((k.decode(), v)
+                             for k, v in counter.iteritems(count=50))
+                self.assertEqual(items, values)
+                self.assertEqual(len(set(counter.iterkeys(count=50))), 300)
+                self.assertEqual(sum(counter.itervalues()), counter.total())
+                self.assertEqual(counter.total(), sum(values.values()))
+        finally:
+            ranked.delete()
+
+    def test_update_counters(self):
+        for atomic in [False, True]:
+            values = (k for k in ['a', 'b', 'a'])
+            counters.update_counters('test_counter', values, ['day', 'month'],
+                                     self.dt, atomic=atomic)
+        for counter in [self.day, self.month]:
+            self.assertEqual(dict(counter.items()), {b'a': 4, b'b': 2})
+
+    def test_ranked_counter(self):
+        counter = counters.RankedDayCounter.from_date('test_counter', self.dt)
+        try:
+            self.assertEqual(counter.key, 'spm:rcnt:test_counter:2015-03-01')
+            counter.update({'a': 2, 'b': 5}, c=1)
+            counter.subtract(['b'])
+            counters.update_counters('test_counter', ['c', 'c', 'd'],
+                                     counters.RankedDayCounter, self.dt)
+            self.assertEqual(counter.most_common(2), [(b'b', 4), (b'c', 3)])
+            self.assertEqual(counter.total(), 10)
+            self.assertEqual(counter.most_common_percent(1), [(b'b', 40.0)])
+            self.assertEqual(counter.get_many(['a', 'x', 'c'], 0), [2, 0, 3])
+            counter['a'] = 5
+            self.assertEqual(counter.setdefault('a', 1), 5)
+            self.assertEqual(counter.pop('d'), 1)
+            self.assertFalse('d' in counter)
+            self.assertEqual((len(counter), counter.total()), (3, 12))
+            counter.union_update({'a': 1, 'e': 2})
+            self.assertEqual(counter.total(), 14)
+            counter.intersection_update({'a': 1, 'b': 10})
+            self.assertEqual(sorted(counter.items()), [(b'a', 1), (b'b', 4)])
+            self.assertEqual(counter.total(), 5)
+        finally:
+            counter.delete()
+
+    def test_most_common_range(self):
+        start, end = datetime(2015, 2, 27), datetime(2015, 3, 2)
+        cleanup = []
+        for ranked in [False, True]:
+            types = counters.RANKED_COUNTER_ALIASES if ranked \
+                else counters.COUNTER_ALIASES
+            for day, values in [(27, {'a': 1, 'b': 5}), (28, {'a': 3}),
+                                (2, {'c': 2}), (3, {'a': 100})]:
+                month = 3 if day < 27 else 2
+                counter = types['day']('test_counter', 2015, month, day)
+                counter.update(values)
+                cleanup.append(counter)
+            counter_class = counters.RankedCounter if ranked \
+                else counters.Counter
+            self.assertEqual(
+                counter_class.most_common_range('test_counter', start, end, 2),
+                [(b'b', 5), (b'a', 4)])
+            top = types['day'].most_common_range('test_counter', start, end,
+                                                 ttl=60)
+            self.assertEqual(top, [(b'b', 5), (b'a', 4), (b'c', 2)])
+            cleanup[-2].update(['b'] * 10)  # cached sum is not changed
+            self.assertEqual(
+                types['day'].most_common_range('test_counter', start, end, 1,
+                                               ttl=60), [(b'b', 5)])
+        # Many periods
+        counter = counters.RankedHourCounter('test_counter', 2015, 6, 1, 0)
+        counter.update({'a': 2})
+        cleanup.append(counter)
+        self.assertEqual(counters.RankedHourCounter.most_common_range(
+            'test_counter', datetime(2015, 1, 1), datetime(2015, 12, 31, 23)),
+            [(b'a', 2)])
+        for counter in cleanup:
+            counter.delete()
+        for key in client.keys('spm:*cnt:range_top:*'):
+            client.delete(key)
+
+    def test_buffer(self):
+        buf = buffers.CounterBuffer(max_size=4, flush_interval=0)
+        day = counters.DayCounter.from_date('test_counter', self.dt, buffer=buf)
+        day.update(['a', 'b', 'a'])
+        counters.update_counters('test_counter', {'a': 2}, ['day', 'month'],
+                                 self.dt, buffer=buf)
+        self.assertEqual((len(buf), len(day)), (3, 0))
+        self.assertEqual(self.month.buffer, None)
+        counters.update_counters('test_counter', ['c'], 'month', self.dt,
+                                 buffer=buf)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(dict(day.items()), {b'a': 4, b'b': 1})
+        self.assertEqual(dict(self.month.items()), {b'a': 2, b'c': 1})
+        stats = buf.stats()
+        self.assertEqual((stats['flushes'], stats['flushed_fields']), (1, 4))
+        self.assertEqual(stats['increments'], 5)
+        self.assertEqual(buf.flush(), 0)
+
+    def test_buffer_background_flush(self):
+        buf = buffers.CounterBuffer(flush_interval=0.01)
+        try:
+            self.day.buffer = buf
+            self.day.update(a=5)
+            time.sleep(0.1)
+            self.assertEqual(self.day.get('a'), 5)
+        finally:
+            buf.close()
+
+
 ##############################################################################
 # Timeline Tests
 ##############################################################################
@@ -20,9 +811,10 @@ client = conf.register_connection()
 class TimelineTestCase(unittest.TestCase):
 
     timeline_class = timelines.Timeline
+    timeline_kwargs = {}
 
     def setup_timeline(self):
-        self.timeline = self.timeline_class('test')
+        self.timeline = self.timeline_class('test', **self.timeline_kwargs)
         self.start_time = int(time.time())
         self.items = []
 
@@ -90,6 +882,39 @@ class TimelineTestCase(unittest.TestCase):
         items2 = self.timeline.timerange(start_ts, end_ts)
         self.assert_ranges_equal(items1, items2)
 
+    def test_iter_timerange(self):
+        # Equal timestamps span several pages
+        ties = [{'tie': i} for i in range(5)]
+        self.timeline.add(*ties, timestamp=self.start_time + 3)
+        expected = self.timeline.timerange()
+        for page_size in [1, 2, 3, 100]:
+            items = list(self.timeline.iter_timerange(page_size=page_size))
+            self.assertEqual(sorted(map(str, items)), sorted(map(str, expected)))
+            self.assertEqual([t for _, t in items], [t for _, t in expected])
+            items = list(self.timeline.iter_timerange(page_size=page_size,
+                                                      reverse=True))
+            self.assertEqual(sorted(map(str, items)), sorted(map(str, expected)))
+            self.assertEqual([t for _, t in items], [t for _, t in expected][::-1])
+        start, end = self.items[2][1], self.items[4][1]
+        items = list(self.timeline.iter_timerange(start, end, page_size=2))
+        self.assertEqual(len(items), 3 + len(ties))
+
+    def test_capped(self):
+        capped = self.timeline.clone(max_length=5)
+        capped.add({'index': 10}, timestamp=self.start_time + 10)
+        self.assert_ranges_equal(self.items[-4:] + [({'index': 10}, self.start_time + 10)],
+                                 self.timeline.items())
+        capped = self.timeline.clone(max_age=60)
+        capped.add({'index': 11}, timestamp=self.start_time - 120)
+        capped.add({'index': 12})
+        items = self.timeline.items()
+        self.assertEqual(len(items), 6)
+        self.assertIn({'index': 12}, [item for item, _ in items])
+        self.assertEqual(capped.clone().max_age, 60)
+        capped = self.timeline.clone(max_length=10)
+        capped.add(*range(10000), timestamp=self.start_time + 20)
+        self.assertEqual(len(self.timeline), 10)
+
     def test_count_timerange(self):
         items1 = self.items[2:5]
         start, end = self.items[2], self.items[4]
@@ -126,6 +951,66 @@ class YearTimelineTestCase(TimelineTestCase):
     timeline_class = timelines.YearTimeline
 
 
+class CompactTimelineTestCase(TimelineTestCase):
+    timeline_kwargs = {'compact': True}
+
+    def test_formats(self):
+        legacy = self.timeline_class('test', compact=False)
+        legacy.add({'index': 'legacy'}, timestamp=self.start_time + 100)
+        self.timeline.add({'index': 1}, {'index': 1},
+                          timestamp=self.start_time + 200)
+        members = self.timeline.client.zrange(self.timeline.key, -3, -1)
+        self.assertEqual(members[-1][:1], timelines.COMPACT_HEADER)
+        self.assertTrue(len(members[-1]) < len(members[0]))
+        # Equal items are not merged, both formats are readable.
+        self.assertEqual(len(self.timeline), len(self.items) + 3)
+        self.assertEqual(legacy.tail(3), [
+            ({'index': 'legacy'}, self.start_time + 100),
+            ({'index': 1}, self.start_time + 200),
+            ({'index': 1}, self.start_time + 200)])
+
+
+class CompactDayTimelineTestCase(CompactTimelineTestCase):
+    timeline_class = timelines.DayTimeline
+
+
+class MergedTimelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.day1 = datetime(2015, 3, 13)
+        self.day2 = datetime(2015, 3, 14)
+        self.start = calendar.timegm(self.day1.timetuple())
+        self.timelines = [timelines.DayTimeline.from_date('test', self.day1),
+                          timelines.DayTimeline.from_date('test', self.day2)]
+        self.items = []
+        for i in range(6):
+            t = self.start + i * 3600 * 8
+            timeline = self.timelines[i // 3]
+            timeline.add({'index': i}, timestamp=t)
+            self.items.append(({'index': i}, t))
+        # Late item added to the next day
+        self.timelines[1].add({'index': 'late'}, timestamp=self.start + 1)
+        self.items.insert(1, ({'index': 'late'}, self.start + 1))
+
+    def tearDown(self):
+        for timeline in self.timelines:
+            timeline.delete()
+
+    def test_merged_timerange(self):
+        end = self.start + 86400 * 2 - 1
+        merge = timelines.DayTimeline.merged_timerange
+        self.assertEqual(list(merge('test', self.start, end, page_size=2)),
+                         self.items)
+        self.assertEqual(list(merge('test', self.start, end, limit=3)),
+                         self.items[:3])
+        self.assertEqual(list(merge('test', self.start, end, 4, reverse=True)),
+                         self.items[::-1][:4])
+        self.assertEqual(list(timelines.Timeline.merged_timerange(
+            'test', self.start + 3600, self.start + 86400)), self.items[2:5])
+        self.assertEqual(list(merge('test', self.start, end, period='hour')), [])
+        self.assertRaises(ValueError, merge, 'test', None, end)
+
+
 ##############################################################################
 # Time Indexed Keys Tests
 ##############################################################################
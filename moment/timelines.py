@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import heapq
+import itertools
+from datetime import datetime
 from . import conf
-from .base import Base, BaseHour, BaseDay, BaseWeek, BaseMonth, BaseYear
+from .base import (
+    Base, BaseHour, BaseDay, BaseWeek, BaseMonth, BaseYear, MixinPeriod
+)
 from .collections import MixinSerializable
+from .lua import capped_zadd
 
 __all__ = ['TIMELINE_NAMESPACE', 'TIMELINE_ALIASES', 'Timeline',
            'HourTimeline', 'DayTimeline', 'WeekTimeline',
@@ -13,6 +20,10 @@ __all__ = ['TIMELINE_NAMESPACE', 'TIMELINE_ALIASES', 'Timeline',
 
 TIMELINE_NAMESPACE = 'tln'
 
+# First byte of compact members, it's never produced by known serializers.
+COMPACT_HEADER = b'\xff'
+COMPACT_NONCE_SIZE = 4
+
 
 def _totimerange(start_time, end_time):
     if start_time is None:
@@ -22,14 +33,123 @@ def _totimerange(start_time, end_time):
     return start_time, end_time
 
 
+def _fetch_page(client, key, start_time, end_time, offset, count, reverse):
+    if reverse:
+        return client.zrevrangebyscore(key, end_time, start_time, offset,
+                                       count, withscores=True)
+    return client.zrangebyscore(key, start_time, end_time, offset, count,
+                                withscores=True)
+
+
+def _iter_period(client, key, page, start_time, end_time, count, reverse):
+    """
+    Yields `(sort_score, member, score)` of `key` starting from the
+    prefetched first `page`, next pages are fetched on demand.
+    """
+    sign, offset = (-1 if reverse else 1), 0
+    while True:
+        for member, score in page:
+            yield sign * score, member, score
+        if len(page) < count:
+            break
+        offset += count
+        page = _fetch_page(client, key, start_time, end_time, offset, count,
+                           reverse)
+
+
+def _iter_merged(timeline, keys, start_time, end_time, limit, page_size,
+                 reverse):
+    client = timeline.client
+    count = min(page_size, limit) if limit else page_size
+
+    with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            _fetch_page(pipe, key, start_time, end_time, 0, count, reverse)
+        pages = pipe.execute()
+
+    streams = [_iter_period(client, key, page, start_time, end_time, count,
+                            reverse)
+               for key, page in zip(keys, pages)]
+    for member, score in itertools.islice(_merge_periods(streams), limit):
+        yield timeline._loads_member(member, score)
+
+
+def _decorate(stream, index):
+    # Stream index and item position keep ties away from comparing members.
+    for position, (sort_score, member, score) in enumerate(stream):
+        yield sort_score, index, position, member, score
+
+
+def _merge_periods(streams):
+    decorated = [_decorate(s, i) for i, s in enumerate(streams)]
+    for _, _, _, member, score in heapq.merge(*decorated):
+        yield member, score
+
+
 class Timeline(Base, MixinSerializable):
+    """
+    Sorted set of items scored by timestamp. Compact timelines (see
+    `conf.MOMENT_TIMELINE_COMPACT`) store serialized item prefixed by a
+    header byte and a random nonce, which keeps equal items unique, and
+    read timestamps from scores. Otherwise items are stored as
+    `{'d': data, 't': timestamp}` documents. Both formats are readable by
+    any timeline, so existing timelines can be switched to compact mode.
+
+    Capped timelines keep at most `max_length` newest items and/or items
+    not older than `max_age` seconds, `add()` trims them in the same
+    script call.
+    """
     namespace = TIMELINE_NAMESPACE
     key_format = '{self.name}'
-    clonable_attrs = ['serializer']
+    clonable_attrs = ['serializer', 'compact', 'max_length', 'max_age']
+    max_length = None
+    max_age = None
 
-    def __init__(self, name, client='default', serializer=None):
+    def __init__(self, name, client='default', serializer=None, compact=None,
+                 max_length=None, max_age=None):
         super(Timeline, self).__init__(name, client)
         self.serializer = conf.get_serializer(serializer)
+        self.compact = conf.MOMENT_TIMELINE_COMPACT if compact is None \
+            else compact
+        if max_length is not None:
+            self.max_length = max_length
+        if max_age is not None:
+            self.max_age = max_age
+
+    @classmethod
+    def merged_timerange(cls, name, start_time, end_time, limit=None,
+                         period=None, client='default', serializer=None,
+                         page_size=1000, reverse=False):
+        """
+        Lazily yields items of `name` timelines of all periods between
+        `start_time` and `end_time` timestamps (both are required, periods
+        of open ranges are unknown) merged in timestamp order
+        (newest first if `reverse`), at most `limit` items. First pages of
+        all periods are fetched by one pipeline, next pages of a period are
+        fetched only when the merge reaches its end, so nothing more is
+        read once `limit` items are yielded. Items may have any timestamp
+        within the range regardless of the period they were added to.
+        Period defaults to the class period or day.
+
+        Examples::
+
+            end = time.time()
+            for data, ts in HourTimeline.merged_timerange('events', end - 86400 * 2, end, 100):
+                print data, ts
+            Timeline.merged_timerange('events', start, end, period='week')
+        """
+        if start_time is None or end_time is None:
+            raise ValueError('Both `start_time` and `end_time` are required '
+                             'to find timeline periods.')
+        if period is None:
+            period = cls if issubclass(cls, MixinPeriod) else 'day'
+        timeline_type = TIMELINE_ALIASES.get(period, period)
+        timeline = timeline_type(name, client=client, serializer=serializer)
+        keys = list(timeline_type.period_keys(
+            name, datetime.utcfromtimestamp(start_time),
+            datetime.utcfromtimestamp(end_time)))
+        return _iter_merged(timeline, keys, start_time, end_time, limit,
+                            page_size, reverse)
 
     def encode(self, data, timestamp):
         return {'d': data, 't': timestamp}
@@ -37,6 +157,19 @@ class Timeline(Base, MixinSerializable):
     def decode(self, value):
         return value.get('d'), value.get('t')
 
+    def _dumps_member(self, item, timestamp):
+        if not self.compact:
+            return self.dumps(self.encode(item, timestamp))
+        data = self.dumps(item)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return COMPACT_HEADER + os.urandom(COMPACT_NONCE_SIZE) + data
+
+    def _loads_member(self, member, score):
+        if member[:1] == COMPACT_HEADER:
+            return self.loads(member[1 + COMPACT_NONCE_SIZE:]), score
+        return self.decode(self.loads(member))
+
     def add(self, *items, **kwargs):
         """
         Add new item to `timeline`
@@ -45,23 +178,72 @@ class Timeline(Base, MixinSerializable):
 
             tl = Timeline('events')
             tl.add('event1', 'event2', timestamp=time.time())
+            tl = Timeline('events', max_length=1000, max_age=3600)
+            tl.add('event3')  # also trims old items
         """
         assert items, 'At least one item should be given.'
 
-        timestamp = kwargs.get('timestamp') or time.time()
+        now = time.time()
+        timestamp = kwargs.get('timestamp') or now
         args = []
         for item in items:
             args.append(timestamp)
-            args.append(self.dumps(self.encode(item, timestamp)))
-        self.client.zadd(self.key, *args)
+            args.append(self._dumps_member(item, timestamp))
+        if self.max_length or self.max_age:
+            min_score = repr(float(now - self.max_age)) if self.max_age else ''
+            capped_zadd(keys=[self.key],
+                        args=[self.max_length or 0, min_score] + args,
+                        client=self.client)
+        else:
+            self.client.zadd(self.key, *args)
         return timestamp
 
     def timerange(self, start_time=None, end_time=None, limit=None):
         start_time, end_time = _totimerange(start_time, end_time)
         offset = None if limit is None else 0
-        items = self.client.zrangebyscore(self.key, start_time,
-                                          end_time, offset, limit)
-        return [self.decode(self.loads(i)) for i in items]
+        items = self.client.zrangebyscore(self.key, start_time, end_time,
+                                          offset, limit, withscores=True)
+        return [self._loads_member(m, s) for m, s in items]
+
+    def iter_timerange(self, start_time=None, end_time=None, page_size=1000,
+                       reverse=False):
+        """
+        Lazily iterates over items between `start_time` and `end_time`,
+        items are fetched by `page_size` items per call and decoded as they
+        go (newest first if `reverse`). Paging cursor is the last score and
+        the number of already seen items with this score, so items with
+        equal timestamps are neither skipped nor repeated.
+
+        Examples ::
+
+            tl = DayTimeline('events')
+            for data, timestamp in tl.iter_timerange(page_size=500):
+                print data, timestamp
+        """
+        start_time, end_time = _totimerange(start_time, end_time)
+        cursor, ties = (end_time if reverse else start_time), 0
+        while True:
+            if reverse:
+                page = self.client.zrevrangebyscore(
+                    self.key, cursor, start_time, ties, page_size,
+                    withscores=True)
+            else:
+                page = self.client.zrangebyscore(
+                    self.key, cursor, end_time, ties, page_size,
+                    withscores=True)
+            for member, score in page:
+                yield self._loads_member(member, score)
+            if len(page) < page_size:
+                break
+            last = page[-1][1]
+            n = 0
+            for _, score in reversed(page):
+                if score != last:
+                    break
+                n += 1
+            # Whole page has the cursor score, skip more of its items.
+            ties = ties + n if n == len(page) and last == cursor else n
+            cursor = last
 
     def delete_timerange(self, start_time=None, end_time=None):
         start_time, end_time = _totimerange(start_time, end_time)
@@ -72,8 +254,8 @@ class Timeline(Base, MixinSerializable):
         return self.client.zcount(self.key, start_time, end_time)
 
     def range(self, start=0, end=-1):
-        items = self.client.zrange(self.key, start, end)
-        return [self.decode(self.loads(i)) for i in items]
+        items = self.client.zrange(self.key, start, end, withscores=True)
+        return [self._loads_member(m, s) for m, s in items]
 
     def delete_range(self, start=0, end=-1):
         return self.client.zremrangebyrank(self.key, start, end)
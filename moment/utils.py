@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import calendar
 from datetime import date, timedelta
+from .compat import numpy
+
+
+# Offsets of set bits for every byte value, most significant bit first.
+_BYTE_BITS = [tuple(i for i in range(8) if byte & (0x80 >> i))
+              for byte in range(256)]
 
 
 def add_month(year, month, delta):
@@ -23,6 +30,11 @@ def not_none(*keys):
             return key
 
 
+def to_timestamp(dt):
+    """ Unix timestamp of naive UTC `datetime`. """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
 def iso_year_start(iso_year):
     """ The gregorian calendar date of the first day of the given ISO year. """
     fourth_jan = date(iso_year, 1, 4)
@@ -34,3 +46,20 @@ def iso_to_gregorian(iso_year, iso_week, iso_day):
     """ Gregorian calendar date for the given ISO year, week and day. """
     year_start = iso_year_start(iso_year)
     return year_start + timedelta(days=iso_day - 1, weeks=iso_week - 1)
+
+
+def iter_set_bits(data, offset=0):
+    """
+    Yields offsets of set bits in `data` (redis bitmap chunk) shifted by
+    `offset`. Uses numpy when available.
+    """
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+        for index in numpy.flatnonzero(bits).tolist():
+            yield offset + index
+        return
+    for index, byte in enumerate(bytearray(data)):
+        if byte:
+            base = offset + index * 8
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit